@@ -1,8 +1,10 @@
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
 
+from osm_reader import get_element
+import tag_index
+
 # We are following the same procedure as in the audit_street_names.py
 # script, but this time we will audit and update amenities.
 
@@ -37,13 +39,11 @@ def is_amenity(elem):
 
 # Function to audit / collect unsual, unexpected amenities, which is calls upon audit_amenity function
 def audit_amenities(osm_filename):
-    osm_file = open(osm_filename, "r")
     amenities = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_amenity(tag):
-                    audit_amenity(amenities, tag.attrib['v'])
+    for elem in get_element(osm_filename, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_amenity(tag):
+                audit_amenity(amenities, tag.attrib['v'])
     pprint.pprint(dict(amenities))
 
 
@@ -56,11 +56,26 @@ amenity_mapping = {
 }
 
 
+# Compiled patterns of each mapping passed to update_amenity, keyed by the mapping items
+_amenity_patterns = {}
+
+
+# Function to compile the word-boundary pattern of every amenity in a mapping, once per mapping
+def compile_amenity_mapping(amenity_mapping):
+    key = tuple(sorted(amenity_mapping.items()))
+    patterns = _amenity_patterns.get(key)
+    if patterns is None:
+        patterns = [(amenity, re.compile(r'\b' + re.escape(amenity)), replacement)
+                    for amenity, replacement in amenity_mapping.items()]
+        _amenity_patterns[key] = patterns
+    return patterns
+
+
 # Function used to update amenities, following mapping dictionary
 def update_amenity(name, amenity_mapping):
-    for amenity in amenity_mapping:
+    for amenity, pattern, replacement in compile_amenity_mapping(amenity_mapping):
         if amenity in name:
-            name = re.sub(r'\b' + re.escape(amenity), amenity_mapping[amenity], name)
+            name = pattern.sub(replacement, name)
     return name
 
 
@@ -74,18 +89,8 @@ def is_amenity_matched(elem, amenity):
 
 # Function to retrieves additional information stored in tags adjacent to a given amenity tag
 # This helps to get more insight about a given amenity, such as, postal code, type of building, etc
-def check_amenity_details(osmfile, amenity):
-    osm_file = open(osmfile, "r")
-    tags = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_amenity_matched(tag, amenity):
-                    for t in elem.iter("tag"):
-                        tags[t.attrib['k']] = t.attrib['v']
-    osm_file.close()
-
-    return tags
+def check_amenity_details(osmfile, amenity, index_path=None):
+    return tag_index.check_details(osmfile, ("amenity",), amenity, index_path)
 
 
 if __name__ == '__main__':
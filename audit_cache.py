@@ -0,0 +1,103 @@
+import os
+import sqlite3
+from collections import Counter
+
+from cache_meta import AUDIT_KEYS, AUDIT_TYPES, file_hash, is_current
+from osm_reader import get_element
+
+# Re-running the audits after a change to their rules (expected, expected_amenities,
+# the mapping dicts) used to mean parsing the whole OSM file again, although the
+# data had not changed. The audits only look at tag values, so this script stores
+# one value -> count histogram per tag key in an on-disk cache, and the audits can
+# be replayed against the histograms instead of the file.
+#
+# The cache is keyed by the size, mtime and SHA-1 of the OSM file. When the size and
+# mtime match it is used as is; when only the mtime changed (a copy, a touch) the
+# file is hashed and the cache is kept if the content is the same.
+
+BATCH_SIZE = 10000
+
+
+# Function returning the default cache location, stored next to the OSM file
+def default_cache_path(osmfile):
+    return osmfile + ".audit.db"
+
+
+# Function to count the values of the given tag keys, with a single pass over the OSM file
+def count_values(osmfile, keys=AUDIT_KEYS, types=AUDIT_TYPES):
+    """
+        returns a dictionary of tag key -> Counter of its values
+    """
+    keys = None if keys is None else frozenset(keys)
+    histograms = {}
+    for elem in get_element(osmfile, tags=types):
+        for tag in elem.iter("tag"):
+            k = tag.attrib['k']
+            if keys is None or k in keys:
+                histogram = histograms.get(k)
+                if histogram is None:
+                    histogram = histograms[k] = Counter()
+                histogram[tag.attrib['v']] += 1
+    return histograms
+
+
+# Function to build the histogram cache of an OSM file, returns the histograms
+def build_cache(osmfile, cache_path=None, keys=AUDIT_KEYS, types=AUDIT_TYPES):
+    cache_path = cache_path or default_cache_path(osmfile)
+    stat = os.stat(osmfile)
+    sha1 = file_hash(osmfile)
+    histograms = count_values(osmfile, keys, types)
+
+    # Written to a temporary file first, an interrupted build leaves the old cache alone
+    tmp_path = cache_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    cur = conn.cursor()
+    cur.execute('CREATE TABLE histogram (key TEXT, value TEXT, count INTEGER);')
+    cur.execute('CREATE TABLE meta (size INTEGER, mtime REAL, sha1 TEXT, keys TEXT, types TEXT);')
+    rows = []
+    for k, histogram in histograms.iteritems():
+        for v, count in histogram.iteritems():
+            rows.append((k, v, count))
+            if len(rows) >= BATCH_SIZE:
+                cur.executemany('INSERT INTO histogram(key, value, count) VALUES (?, ?, ?);', rows)
+                rows = []
+    cur.executemany('INSERT INTO histogram(key, value, count) VALUES (?, ?, ?);', rows)
+    cur.execute('CREATE INDEX histogram_key ON histogram (key);')
+    cur.execute('INSERT INTO meta(size, mtime, sha1, keys, types) VALUES (?, ?, ?, ?, ?);',
+                (stat.st_size, stat.st_mtime, sha1, None if keys is None else '\n'.join(keys), '\n'.join(types)))
+    conn.commit()
+    conn.close()
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    os.rename(tmp_path, cache_path)
+    return histograms
+
+
+# Function returning the value histograms of the given tag keys, from the cache when
+# it is current and from a new pass over the OSM file (which refreshes it) otherwise
+def load_histograms(osmfile, keys=AUDIT_KEYS, cache_path=None, types=AUDIT_TYPES):
+    """
+        returns a dictionary of tag key -> Counter of its values
+    """
+    cache_path = cache_path or default_cache_path(osmfile)
+    if not is_current(osmfile, cache_path, keys, types):
+        histograms = build_cache(osmfile, cache_path, keys, types)
+        return histograms if keys is None else dict((k, histograms[k]) for k in keys if k in histograms)
+
+    conn = sqlite3.connect(cache_path)
+    conn.text_factory = unicode
+    if keys is None:
+        rows = conn.execute('SELECT key, value, count FROM histogram;')
+    else:
+        rows = conn.execute('SELECT key, value, count FROM histogram WHERE key IN ({0});'.format(
+            ', '.join('?' * len(keys))), tuple(keys))
+    histograms = {}
+    for k, v, count in rows:
+        histogram = histograms.get(k)
+        if histogram is None:
+            histogram = histograms[k] = Counter()
+        histogram[v] = count
+    conn.close()
+    return histograms
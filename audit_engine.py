@@ -0,0 +1,122 @@
+from collections import defaultdict
+
+from osm_reader import OsmElement, get_element
+import audit_cache
+from cache_meta import AUDIT_KEYS
+import tag_index
+from value_counts import ValueCounter, ValueCounts, print_report
+from audit_street_name import is_street_name, audit_street_type
+from audit_postal_code import is_post_code, audit_post_code
+from audit_house_number import is_house_number, audit_house_number
+from audit_amenities import is_amenity, audit_amenity
+
+# Each audit_* script parses the whole OSM file on its own, so running all of them
+# means one full parse per script. This engine parses the file once and hands
+# every <tag> to all the registered auditors.
+osm_filename = "bristol_map.osm"
+
+# Registered auditors: name -> (tag filter, audit function, result factory)
+# The audit function is called as audit(result, value), same as the audit_* scripts
+AUDITORS = {
+    "street_types": (is_street_name, audit_street_type, lambda: defaultdict(set)),
+    "post_codes": (is_post_code, audit_post_code, set),
+    "house_numbers": (is_house_number, audit_house_number, set),
+    "amenities": (is_amenity, audit_amenity, lambda: defaultdict(set)),
+}
+
+
+class AuditEngine(object):
+    """Dispatch tag values to a set of auditors and keep one result per auditor
+
+    Alongside the results, the engine counts how often each value is seen: per
+    auditor for the values it inspected (matched) and per tag key for every tag
+    (value_counts, None when count_values is off), see value_counts.
+    """
+
+    def __init__(self, auditors=None, count_values=True):
+        self.auditors = AUDITORS if auditors is None else auditors
+        self.results = {}
+        self.matched = {}
+        for name, (_, _, factory) in self.auditors.iteritems():
+            self.results[name] = factory()
+            self.matched[name] = ValueCounter()
+        self.value_counts = ValueCounts() if count_values else None
+
+    # Function to register an extra auditor after the engine has been created
+    def register(self, name, is_match, audit, factory=set):
+        self.auditors = dict(self.auditors)
+        self.auditors[name] = (is_match, audit, factory)
+        self.results[name] = factory()
+        self.matched[name] = ValueCounter()
+
+    # Function to pass a single <tag> element to every auditor interested in it,
+    # count is the number of times the tag is seen
+    def audit_tag(self, tag, count=1):
+        value = tag.attrib['v']
+        if self.value_counts is not None:
+            self.value_counts.add(tag.attrib['k'], value, count)
+        for name, (is_match, audit, _) in self.auditors.iteritems():
+            if is_match(tag):
+                audit(self.results[name], value)
+                self.matched[name].add(value, count)
+
+    # Function to replay the audit on cached tag key -> value histograms, see audit_cache
+    # The auditors collect sets, so each distinct value only has to be audited once
+    def audit_histograms(self, histograms):
+        for k, histogram in histograms.iteritems():
+            for v, count in histogram.iteritems():
+                self.audit_tag(OsmElement('tag', {'k': k, 'v': v}), count)
+
+    # Function returning the values an auditor flagged with how often each was seen,
+    # most frequent first: the ones worth a cleaner at the top, one-off typos at the end
+    def flagged_counts(self, name):
+        result = self.results[name]
+        if isinstance(result, dict):
+            values = set().union(*result.values())
+        else:
+            values = result
+        counter = self.matched[name]
+        return sorted(((v, counter.count(v)) for v in values), key=lambda item: (-item[1], item[0]))
+
+
+# Function to run all the registered auditors with a single pass over the OSM file,
+# returns the AuditEngine holding the results and the value counts
+# When build_index is set, the tag index used by the check_*_details functions is
+# built during the same pass
+# With cache set, the audit runs on the value histograms of audit_cache instead, only
+# parsing the file when it changed: use it to re-audit after changing the rules.
+# Auditors looking at other keys than AUDIT_KEYS need cache_keys, and
+# value counts of every tag key need cache_keys=None.
+def run_audit(osmfile, auditors=None, build_index=False, index_path=None, cache=False, cache_path=None,
+              cache_keys=AUDIT_KEYS):
+    engine = AuditEngine(auditors)
+    if cache:
+        engine.audit_histograms(audit_cache.load_histograms(osmfile, cache_keys, cache_path))
+    elif build_index:
+        tag_index.build_index(osmfile, index_path, engine=engine)
+    else:
+        for elem in get_element(osmfile, tags=('node', 'way')):
+            for tag in elem.iter("tag"):
+                engine.audit_tag(tag)
+    return engine
+
+
+# Function to run all the registered auditors, see run_audit
+def audit_all(osmfile, auditors=None, build_index=False, index_path=None, cache=False, cache_path=None,
+              cache_keys=AUDIT_KEYS):
+    """
+        returns a dictionary of auditor name -> audit result, where each result has
+        the same structure as the corresponding audit_* script
+    """
+    return run_audit(osmfile, auditors, build_index, index_path, cache, cache_path, cache_keys).results
+
+
+if __name__ == "__main__":
+    engine = run_audit(osm_filename, cache=True, cache_keys=None)
+    # Flagged values, most frequent first
+    for name in sorted(engine.results):
+        print(name)
+        for value, count in engine.flagged_counts(name):
+            print(u'    {0:>8}  {1}'.format(count, value).encode('utf-8'))
+    # Most frequent values of every tag key
+    print_report(engine.value_counts.report())
@@ -1,13 +1,15 @@
-import xml.etree.cElementTree as ET
-from collections import defaultdict
 import re
 import pprint
 
+from osm_reader import get_element
+from column_re import ColumnPattern, map_column
+import tag_index
+
 # We are following the same procedure as in the audit_street_names.py
 # script, but this time we will audit and update house numbers.
 osm_filename = "bristol_map.osm"
-house_num1_re = re.compile(r'\d+\w?$', re.IGNORECASE)
-house_num2_re = re.compile(r'\d+\w?-\d+\w?$', re.IGNORECASE)
+# A number or a range of numbers, each with an optional letter: "12", "12a", "12-14b"
+house_number_re = re.compile(r'\d+\w?(?:-\d+\w?)?$', re.IGNORECASE)
 
 
 # Function to check whether an element of XML is effectively a house number
@@ -25,10 +27,7 @@ def audit_house_number(house_numbers, house_number):
         post_codes (set): unexpected post codes.
         post_code (str): post code data.
     """
-    m1 = house_num1_re.match(house_number)
-    m2 = house_num2_re.match(house_number)
-
-    if not (m1 or m2):
+    if not house_number_re.match(house_number):
         house_numbers.add(house_number)
 
 
@@ -37,15 +36,11 @@ def audit_house_numbers(osmfile):
     """
         returns me a dictionary that match the above function conditions
     """
-    osm_file = open(osmfile, "r")
     house_numbers = set()
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_house_number(tag):
-                    audit_house_number(house_numbers, tag.attrib['v'])
-    osm_file.close()
+    for elem in get_element(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_house_number(tag):
+                audit_house_number(house_numbers, tag.attrib['v'])
     return house_numbers
 
 
@@ -59,19 +54,8 @@ def is_house_number_matched(elem, number):
 
 # Function which retrieves additional information stored in tags adjacent to a given house number tag
 # This helps to get more insight about a given house number, such as, postal code, type of building, etc
-def check_house_details(osmfile, number):
-    osm_file = open(osmfile, "r")
-    tags = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_house_number_matched(tag, number):
-                    for t in elem.iter("tag"):
-                        tags[t.attrib['k']] = t.attrib['v']
-    osm_file.close()
-
-    return tags
+def check_house_details(osmfile, number, index_path=None):
+    return tag_index.check_details(osmfile, ("addr:housenumber",), number, index_path)
 
 
 # Function to correct unusual house numbers, which have been spotted during data auditing
@@ -103,6 +87,63 @@ def update_house_number(number):
     return number
 
 
+# The steps of update_house_number as patterns over a whole column, see column_re:
+# leading and trailing whitespace
+number_leading_space_re = ColumnPattern(r'\x00\s+')
+number_trailing_space_re = ColumnPattern(r'\s\s*(?=\x00)')
+# exactly one ";"
+number_semicolon_re = ColumnPattern(r'\x00[^;\x00]*;[^;\x00]*(?=\x00)')
+# exactly one "-", followed by something else than digits: "9A-C"
+number_suffix_re = ColumnPattern(r'\x00([^-\x00])([^-\x00]*)-((?:[^-\x00]*[^-\x00%(digit)s][^-\x00]*)?)(?=\x00)')
+# the same with nothing before the "-", which update_house_number fails on
+number_no_prefix_re = ColumnPattern(r'\x00-(?:[^-\x00]*[^-\x00%(digit)s][^-\x00]*)?(?=\x00)')
+# exactly one "to", then exactly one "--"
+number_to_re = ColumnPattern(r'\x00([^t\x00]*(?:t(?!o)[^t\x00]*)*)to([^t\x00]*(?:t(?!o)[^t\x00]*)*)(?=\x00)')
+number_dash_re = ColumnPattern(r'\x00([^-\x00]*(?:-(?!-)[^-\x00]*)*)--([^-\x00]*(?:-(?!-)[^-\x00]*)*)(?=\x00)')
+
+
+# Function joining with a "-" the two parts of a house number matched around a "to" or "--".
+# Replacement functions are used over templates, re expands a template in Python on each match
+def _join_parts(m):
+    return '\x00%s-%s' % m.groups()
+
+
+# Function repeating the first character of a house number before the suffix after the "-"
+def _expand_suffix(m):
+    first, rest, suffix = m.groups()
+    return '\x00%s%s-%s%s' % (first, rest, first, suffix)
+
+
+# Function running the update_house_number steps on a joined column of house numbers,
+# a step is skipped when no value has the characters it looks for
+def _update_joined_house_numbers(joined):
+    joined = number_leading_space_re.sub('\x00', joined)
+    joined = number_trailing_space_re.sub('', joined).replace(' ', '')
+    if ';' in joined:
+        joined = number_semicolon_re.sub(lambda m: m.group().replace(';', '-').upper(), joined)
+    if '-' in joined:
+        if '\x00-' in joined and number_no_prefix_re.search(joined):
+            return None
+        joined = number_suffix_re.sub(_expand_suffix, joined)
+    if 'to' in joined:
+        joined = number_to_re.sub(_join_parts, joined)
+    if '--' in joined:
+        joined = number_dash_re.sub(_join_parts, joined)
+    return joined
+
+
+# Function to correct a whole column of house numbers, with a pattern per step instead
+# of a split per step and value
+def update_house_numbers(numbers, validate=True):
+    """Return the list of update_house_number(number) for each number, and the list of
+    whether each result is an acceptable house number (house_number_re), None when
+    validate is False"""
+    numbers = map_column(numbers, _update_joined_house_numbers, update_house_number)
+    if not validate:
+        return numbers, None
+    return numbers, [house_number_re.match(number) is not None for number in numbers]
+
+
 if __name__ == "__main__":
     house_numbers = audit_house_numbers(osm_filename)
     pprint.pprint(house_numbers)
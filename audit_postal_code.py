@@ -1,7 +1,9 @@
-import xml.etree.cElementTree as ET
 import pprint
 import re
-from collections import defaultdict
+
+from osm_reader import get_element
+from column_re import ColumnPattern, map_column
+import tag_index
 
 # We are following the same procedure as in the audit_street_names.py
 # script, but this time we will audit and update postal codes.
@@ -43,15 +45,11 @@ def audit_post_codes(osmfile):
     """
         returns me a dictionary that match the above function conditions
     """
-    osm_file = open(osmfile, "r")
     post_codes = set()
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_post_code(tag):
-                    audit_post_code(post_codes, tag.attrib['v'])
-    osm_file.close()
+    for elem in get_element(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_post_code(tag):
+                audit_post_code(post_codes, tag.attrib['v'])
     return post_codes
 
 
@@ -64,19 +62,8 @@ def is_postcode_matched(elem, post_code):
 
 # Function to retrieves additional information stored in tags adjacent to a given post code tag
 # This helps to get more insight about a given post code, such as, street name, house number, etc
-def check_postcode_details(osmfile, post_code):
-    osm_file = open(osmfile, "r")
-    tags = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_postcode_matched(tag, post_code):
-                    for t in elem.iter("tag"):
-                        tags[t.attrib['k']] = t.attrib['v']
-    osm_file.close()
-
-    return tags
+def check_postcode_details(osmfile, post_code, index_path=None):
+    return tag_index.check_details(osmfile, ("addr:postcode", "postal_code"), post_code, index_path)
 
 
 # Function to update post code
@@ -91,6 +78,34 @@ def update_post_code(post_code, mapping):
     return post_code
 
 
+# The steps of update_post_code as patterns over a whole column, see column_re: a
+# value whose part before the first ";" does not end with a digit is cut to that part
+first_post_code_re = ColumnPattern(r'\x00([^;\x00]*[^;\x00%(digit)s]);[^\x00]*')
+
+
+# Function running the update_post_code steps after the mapping on a joined column of post codes
+def _update_joined_post_codes(joined):
+    # Nothing before the first ";", update_post_code fails on these
+    if '\x00;' in joined or '\x00\x00' in joined:
+        return None
+    if ';' in joined:
+        # A function, re expands a template in Python on each match
+        joined = first_post_code_re.sub(lambda m: '\x00' + m.group(1), joined)
+    return joined
+
+
+# Function to update a whole column of post codes, with one pattern instead of a split per value
+def update_post_codes(post_codes, mapping, validate=True):
+    """Return the list of update_post_code(post_code, mapping) for each post code, and
+    the list of whether each result is a well formed UK post code (post_code_re), None
+    when validate is False"""
+    post_codes = [mapping.get(post_code, post_code) for post_code in post_codes]
+    post_codes = map_column(post_codes, _update_joined_post_codes, lambda post_code: update_post_code(post_code, {}))
+    if not validate:
+        return post_codes, None
+    return post_codes, [post_code_re.match(post_code) is not None for post_code in post_codes]
+
+
 if __name__ == "__main__":
     post_codes = audit_post_codes(osm_filename)
     pprint.pprint(post_codes)
@@ -1,8 +1,10 @@
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
 
+from osm_reader import get_element
+import tag_index
+
 # Scrip to audit street names, based on Udacity tutorial
 osm_filename = "bristol_map.osm"
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
@@ -65,15 +67,11 @@ def audit_street_name(osmfile):
     """
         returns me a dictionary that match the above function conditions
     """
-    osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
+    for elem in get_element(osmfile, tags=('node', 'way')):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(street_types, tag.attrib['v'])
     return street_types
 
 
@@ -97,19 +95,8 @@ def update_street_name(name, mapping):
 
 # Function to retrieves additional information stored in tags adjacent to a given street name tag
 # This helps to get more insight about a given street name, such as, postal code, type of building, etc
-def check_street_details(osmfile, letter):
-    osm_file = open(osmfile, "r")
-    tags = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name_letter(tag, letter):
-                    for t in elem.iter("tag"):
-                        tags[t.attrib['k']] = t.attrib['v']
-    osm_file.close()
-
-    return tags
+def check_street_details(osmfile, letter, index_path=None):
+    return tag_index.check_details(osmfile, ("addr:street",), letter, index_path)
 
 
 if __name__ == "__main__":
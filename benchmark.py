@@ -0,0 +1,268 @@
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.cElementTree as ET
+
+# Benchmarks for the OSM wrangling scripts. They run against synthetic OSM files
+# generated on the fly, so they can be run anywhere without downloading an extract.
+
+STREETS = ["High St", "Church Road", "Park street", "A", "Hope Chapel hill", "Mill Lane", "Steppingstones"]
+POST_CODES = ["BS1 3PH;BS1 3PJ", "BS8 1TH", "BS4 1104", "bs7", "BS5 0UE;BS5 0UP"]
+HOUSE_NUMBERS = ["12", "9A-C", "1 to 4", "284--288", "23a;25", "60 The General"]
+AMENITIES = ["cafe", "pub", "grave_yard", "court_yard", "atm; telephone", "bench"]
+
+
+# Function to write a synthetic OSM file with n_nodes nodes, n_nodes / 5 ways and
+# a tag mix similar to the Bristol extract. Plain counters are used instead of
+# range() so the generator itself stays small: subprocesses inherit its peak RSS.
+def write_synthetic_osm(path, n_nodes, seed=1):
+    rnd = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="benchmark">\n')
+        f.write(' <bounds minlat="51.4" minlon="-2.7" maxlat="51.5" maxlon="-2.5"/>\n')
+        i = 0
+        while i < n_nodes:
+            i += 1
+            attrs = 'id="%d" version="2" timestamp="2017-01-01T00:00:00Z" changeset="%d" uid="%d" ' \
+                    'user="user%d" lat="%.7f" lon="%.7f"' % (i, i, i % 50, i % 50,
+                                                             51.4 + rnd.random() * 0.1, -2.7 + rnd.random() * 0.2)
+            if i % 3 == 0:
+                f.write('  <node %s>\n' % attrs)
+                f.write('    <tag k="addr:street" v="%s"/>\n' % rnd.choice(STREETS))
+                f.write('    <tag k="addr:postcode" v="%s"/>\n' % rnd.choice(POST_CODES))
+                f.write('    <tag k="addr:housenumber" v="%s"/>\n' % rnd.choice(HOUSE_NUMBERS))
+                f.write('    <tag k="amenity" v="%s"/>\n' % rnd.choice(AMENITIES))
+                f.write('    <tag k="name:en" v="Place %d"/>\n' % i)
+                f.write('  </node>\n')
+            else:
+                f.write('  <node %s/>\n' % attrs)
+        w = 0
+        while w < n_nodes // 5:
+            w += 1
+            f.write('  <way id="%d" version="1" timestamp="2017-01-01T00:00:00Z" changeset="%d" uid="%d" '
+                    'user="user%d">\n' % (n_nodes + w, w, w % 7, w % 7))
+            start = rnd.randint(1, max(1, n_nodes - 4))
+            for ref in range(start, start + 4):
+                f.write('    <nd ref="%d"/>\n' % ref)
+            f.write('    <tag k="highway" v="residential"/>\n')
+            f.write('    <tag k="addr:street" v="%s"/>\n' % rnd.choice(STREETS))
+            f.write('  </way>\n')
+        f.write('</osm>\n')
+
+
+# Function to run a python snippet in a fresh interpreter and return its peak RSS in MB
+def peak_rss_mb(code):
+    script = "import resource\n" + code + "\n" \
+             "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.check_output([sys.executable, "-c", script], cwd=here)
+    return int(out.strip().splitlines()[-1]) / 1024.0
+
+
+# Memory regression benchmark for the audit scanners: peak RSS must stay flat
+# while the input file grows
+def bench_audit_memory(sizes=(20000, 200000), max_growth=1.5):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        peaks = []
+        for n in sizes:
+            path = os.path.join(tmp_dir, "audit_%d.osm" % n)
+            write_synthetic_osm(path, n)
+            peak = peak_rss_mb("import audit_engine\naudit_engine.audit_all(%r)" % path)
+            peaks.append(peak)
+            print("audit_all  %9d nodes  %8.1f MB file  peak RSS %7.1f MB"
+                  % (n, os.path.getsize(path) / 1048576.0, peak))
+        growth = peaks[-1] / peaks[0]
+        assert growth < max_growth, "audit peak RSS grew %.2fx with file size" % growth
+        return peaks
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# Per-tag cleaning as shape_element did it before the dispatch table: problem
+# character and colon regexes plus two re.findall calls for every tag, then an
+# if/elif chain to pick the cleaner. Kept here as the baseline of bench_tag_cleaning.
+def _legacy_shape_tags(element):
+    import prepare_database as pd
+    tags = []
+    for tag in element.iter("tag"):
+        if not pd.PROBLEMCHARS.search(tag.attrib['k']):
+            node_tag = {'id': element.attrib['id']}
+            node_tag['value'] = pd.update_amenity(tag.attrib['v'], pd.amenity_mapping) \
+                if tag.attrib['k'] == "amenity" else tag.attrib['v']
+            if not pd.LOWER_COLON.search(tag.attrib['k']):
+                node_tag['type'] = 'regular'
+                node_tag['key'] = tag.attrib['k']
+            else:
+                node_tag['type'] = re.findall('^(.+?):+[a-z]', tag.attrib['k'])[0]
+                node_tag['key'] = re.findall('^[a-z|_]+:(.+)', tag.attrib['k'])[0]
+                if node_tag['type'] == "addr" and node_tag['key'] == "street":
+                    node_tag['value'] = pd.update_street_name(tag.attrib['v'], pd.street_mapping)
+                elif node_tag['type'] == "addr" and node_tag['key'] == "postcode":
+                    node_tag['value'] = pd.update_post_code(tag.attrib['v'], pd.pc_mapping)
+                elif node_tag['type'] == "addr" and node_tag['key'] == "housenumber":
+                    node_tag['value'] = pd.update_house_number(tag.attrib['v'])
+            tags.append(node_tag)
+    return tags
+
+
+# Function to parse a synthetic file and keep the elements that have tags in memory
+def _tagged_elements(n_nodes):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "tags.osm")
+        write_synthetic_osm(path, n_nodes)
+        return [e for e in ET.parse(path).getroot() if e.find("tag") is not None]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# Microbenchmark of the per-tag cost of shape_element's tag cleaning
+def bench_tag_cleaning(n_nodes=30000, repeat=3):
+    import prepare_database
+    elements = _tagged_elements(n_nodes)
+    n_tags = sum(len(e.findall("tag")) for e in elements)
+    results = {}
+    for name, shape_tags in (("if/elif chain", _legacy_shape_tags),
+                             ("dispatch table", prepare_database.shape_tags)):
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for element in elements:
+                shape_tags(element)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best / n_tags * 1e6
+        print("%-16s %8d tags  %6.2f us/tag" % (name, n_tags, results[name]))
+    return results
+
+
+# Benchmark of the osm_reader parser backends: elements/sec for each backend that
+# can be used here, on the same file, reading every tag of every element
+def bench_backends(n_nodes=100000):
+    import osm_reader
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "backends.osm")
+        write_synthetic_osm(path, n_nodes)
+        results = {}
+        for backend in osm_reader.available_backends():
+            start = time.time()
+            count = 0
+            for element in osm_reader.get_element(path, tags=('node', 'way'), backend=backend):
+                for tag in element.iter("tag"):
+                    tag.attrib['v']
+                count += 1
+            results[backend] = count / (time.time() - start)
+            print("%-6s %8d elements  %9.0f elements/sec" % (backend, count, results[backend]))
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# Function to shape a synthetic file and keep the shaped records in memory, per csv file
+def _shaped_records(n_nodes):
+    import prepare_database
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "writers.osm")
+        write_synthetic_osm(path, n_nodes)
+        records = dict((field, []) for field in ('node', 'node_tags', 'way', 'way_nodes', 'way_tags'))
+        elements = prepare_database.get_element(path, tags=('node', 'way'))
+        for el in prepare_database.shape_elements(elements):
+            for field, value in el.items():
+                records[field].extend(value if isinstance(value, list) else [value])
+        # Non-ASCII values, so both writers go through their utf-8 encoding
+        for record in records['node_tags'][::10]:
+            record['value'] = u'Caf\xe9 ' + record['value']
+        return records
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# Throughput benchmark of the csv writers for each of the five output files:
+# UnicodeDictWriter (dict per row) against RowWriter (tuples in field order, buffered)
+def bench_csv_writers(n_nodes=100000, repeat=3):
+    import prepare_database as pd
+    from operator import itemgetter
+    records = _shaped_records(n_nodes)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        results = {}
+        for path, fields, field in zip(pd.CSV_PATHS, pd.CSV_FIELDS,
+                                       ('node', 'node_tags', 'way', 'way_nodes', 'way_tags')):
+            rows = records[field]
+            outputs = {}
+            for name in ("UnicodeDictWriter", "RowWriter"):
+                out_path = os.path.join(tmp_dir, "%s.%s" % (name, path))
+                best = None
+                for _ in range(repeat):
+                    start = time.time()
+                    with open(out_path, 'wb') as f:
+                        if name == "UnicodeDictWriter":
+                            writer = pd.UnicodeDictWriter(f, fields)
+                            writer.writeheader()
+                            writer.writerows(rows)
+                        else:
+                            writer = pd.RowWriter(f, fields)
+                            writer.writeheader()
+                            writer.writerows(map(itemgetter(*fields), rows))
+                            writer.close()
+                    elapsed = time.time() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                results[(path, name)] = len(rows) / best
+                with open(out_path, 'rb') as f:
+                    outputs[name] = f.read()
+                print("%-16s %-18s %8d rows  %10.0f rows/sec" % (path, name, len(rows), results[(path, name)]))
+            assert outputs["UnicodeDictWriter"] == outputs["RowWriter"], "%s output differs" % path
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# Benchmark of bounding box lookups on a database loaded from a synthetic file: the
+# spatial_index R*Tree against a scan of the node table, in ms per query
+def bench_spatial_queries(n_nodes=200000, n_queries=200, size=0.005):
+    import sqlite3
+    import osm_to_sql
+    import spatial_index
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "spatial.osm")
+        db_path = os.path.join(tmp_dir, "spatial.db")
+        write_synthetic_osm(path, n_nodes)
+        osm_to_sql.process_map_to_sql(path, db_path)
+        conn = sqlite3.connect(db_path)
+        rnd = random.Random(1)
+        boxes = []
+        for _ in range(n_queries):
+            lat, lon = 51.4 + rnd.random() * 0.1, -2.7 + rnd.random() * 0.2
+            boxes.append((lat, lon, lat + size, lon + size))
+
+        scan = 'SELECT id, lat, lon FROM node WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?;'
+        results = {}
+        found = {}
+        for name, query in (("table scan", lambda b: conn.execute(scan, (b[0], b[2], b[1], b[3])).fetchall()),
+                            ("R*Tree", lambda b: spatial_index.nodes_in_bbox(conn, *b))):
+            start = time.time()
+            found[name] = [sorted(query(b)) for b in boxes]
+            results[name] = (time.time() - start) / n_queries * 1000
+            print("%-10s %8d nodes  %8.3f ms/query" % (name, n_nodes, results[name]))
+        assert found["table scan"] == found["R*Tree"], "R*Tree results differ from the table scan"
+        conn.close()
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    bench_audit_memory()
+    bench_tag_cleaning()
+    bench_backends()
+    bench_csv_writers()
+    bench_spatial_queries()
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import sqlite3
+
+# Shared by the on-disk files derived from an OSM file, the tag index (tag_index)
+# and the value histogram cache (audit_cache): the tag keys and element types they
+# cover by default, and the check that such a file is still current.
+#
+# Both store a single row "meta" table with the size and mtime of the OSM file and
+# the newline separated keys they cover (NULL for every key). Optional columns:
+# sha1 of the OSM file, used when only the mtime changed (a copy, a touch), and the
+# element types covered.
+
+# Keys inspected by the audit scripts; pass keys=None to the builders to cover every tag key
+AUDIT_KEYS = ("addr:street", "addr:postcode", "postal_code", "addr:housenumber", "amenity")
+AUDIT_TYPES = ("node", "way")
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+# Function returning the SHA-1 of a file
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+# Function returning the meta row of a derived file as a dict, None when the file
+# does not exist or is not a database with a meta table
+def read_meta(db_path):
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.execute('SELECT * FROM meta;')
+        row = cur.fetchone()
+    except sqlite3.DatabaseError:
+        return None
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in cur.description], row))
+
+
+# Function to check that a derived file exists, was built from the current content
+# of the OSM file and covers all the given keys (every key for keys=None) and types
+def is_current(osmfile, db_path, keys=(), types=None):
+    meta = read_meta(db_path)
+    if meta is None:
+        return False
+    covered_keys = None if meta['keys'] is None else set(meta['keys'].split('\n'))
+    if keys is None:
+        covered = covered_keys is None
+    else:
+        covered = covered_keys is None or covered_keys.issuperset(keys)
+    if not covered:
+        return False
+    if types is not None and 'types' in meta and set(meta['types'].split('\n')) != set(types):
+        return False
+    stat = os.stat(osmfile)
+    if stat.st_size != meta['size']:
+        return False
+    if stat.st_mtime == meta['mtime']:
+        return True
+    if meta.get('sha1') is None or file_hash(osmfile) != meta['sha1']:
+        return False
+    # Same content, remember the new mtime so the next check skips the hash
+    conn = sqlite3.connect(db_path)
+    conn.execute('UPDATE meta SET mtime = ?;', (stat.st_mtime,))
+    conn.commit()
+    conn.close()
+    return True
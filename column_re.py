@@ -0,0 +1,92 @@
+import itertools
+import re
+import sys
+
+# Helpers of the column at a time cleaners (update_post_codes, update_house_numbers).
+# The values of a column are joined into one string, each one preceded and followed
+# by a separator that cannot occur in XML text, and each cleaning step is a single
+# compiled pattern run over the whole string, so the per-value work happens in the
+# regex engine. Patterns start with the separator before a value, which the engine
+# finds with a plain substring search, and check the end of the value with (?=\x00).
+# Classes matching within a value exclude the separator: [^;\x00].
+#
+# A pattern is compiled for byte strings and for unicode strings, the two types the
+# XML parsers return. %(digit)s stands for the characters isdigit() is True for, to
+# use inside a character class.
+
+SEPARATOR = '\x00'
+
+# Built on first use, scanning every code point takes a fraction of a second
+_unicode_digits = []
+
+
+# Function returning the unicode characters isdigit() is True for, escaped for a
+# character class. Wider than the \d of re.UNICODE, which misses superscripts like u'\xb2'
+def unicode_digit_class():
+    if not _unicode_digits:
+        _unicode_digits.append(u''.join(re.escape(c) for c in itertools.imap(unichr, xrange(sys.maxunicode + 1))
+                                        if c.isdigit()))
+    return _unicode_digits[0]
+
+
+class ColumnPattern(object):
+    """Regular expression over a joined column, compiled for each string type on first use"""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._compiled = {}
+
+    def compiled(self, kind):
+        try:
+            return self._compiled[kind]
+        except KeyError:
+            pass
+        pattern = self.pattern
+        if kind is unicode:
+            if '%(digit)s' in pattern:
+                pattern = pattern % {'digit': unicode_digit_class()}
+            compiled = re.compile(unicode(pattern), re.UNICODE)
+        else:
+            compiled = re.compile(pattern % {'digit': '0-9'})
+        self._compiled[kind] = compiled
+        return compiled
+
+    def sub(self, repl, joined):
+        return self.compiled(type(joined)).sub(repl, joined)
+
+    def search(self, joined):
+        return self.compiled(type(joined)).search(joined)
+
+
+# Function returning [scalar(value) for value in values], computed with clean on the
+# joined values. clean takes the values of one string type joined as described above
+# and returns them cleaned and joined the same way, or None for a column it cannot clean
+# like scalar does: scalar is then called on each value, raising the same errors.
+# Each value keeps its type, byte and unicode strings are cleaned as two columns.
+def map_column(values, clean, scalar):
+    kinds = set(itertools.imap(type, values))
+    if len(kinds) <= 1:
+        return _map_group(values, clean, scalar)
+    results = [None] * len(values)
+    for kind in kinds:
+        indexes = [i for i, value in enumerate(values) if type(value) is kind]
+        for i, result in itertools.izip(indexes, _map_group([values[i] for i in indexes], clean, scalar)):
+            results[i] = result
+    return results
+
+
+def _map_group(values, clean, scalar):
+    if not values:
+        return []
+    kind = type(values[0])
+    if kind not in (str, unicode):
+        return [scalar(value) for value in values]
+    separator = kind(SEPARATOR)
+    joined = separator + separator.join(values) + separator
+    cleaned = None
+    # A separator inside a value would split it in two
+    if joined.count(separator) == len(values) + 1:
+        cleaned = clean(joined)
+    if cleaned is None:
+        return [scalar(value) for value in values]
+    return cleaned[1:-1].split(separator)
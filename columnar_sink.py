@@ -0,0 +1,224 @@
+import array
+import calendar
+import io
+import json
+import os
+import struct
+import sys
+import time
+
+import osm_reader
+from node_store import int64s, write_int64s
+from prepare_database import OSM_PATH, ELEMENT_TAGS, get_element, shape_elements, validate_elements
+
+# Script to write the cleaned OSM data as typed columns instead of CSV text: one
+# NumPy .npy file per column (int64 ids, float64 lat/lon, int32 positions), with
+# the low cardinality string columns (user, key, type) dictionary-encoded as int32
+# codes plus a JSON dictionary, and the free text ones (tag values, member roles) as
+# int64 end offsets into a file of their UTF-8 text. Analysis jobs can memory-map the columns with numpy.load(...,
+# mmap_mode='r') without any parsing. Writing only needs the standard library.
+COLUMNAR_DIR = "columnar"
+FLUSH_SIZE = 65536
+
+# (file prefix, shaped element field, [(column, kind)]), kinds: int64, int32, float64,
+# timestamp (int64 seconds since the epoch), dict (int32 code into <table>.<column>.dict.json)
+# and string (int64 offsets into <table>.<column>.utf8, the column has one more entry than
+# the table has rows: value i is the text between offsets i and i + 1)
+TABLES = [
+    ('nodes', 'node', [('id', 'int64'), ('lat', 'float64'), ('lon', 'float64'), ('user', 'dict'),
+                       ('uid', 'int64'), ('version', 'int32'), ('changeset', 'int64'),
+                       ('timestamp', 'timestamp')]),
+    ('nodes_tags', 'node_tags', [('id', 'int64'), ('key', 'dict'), ('value', 'string'), ('type', 'dict')]),
+    ('ways', 'way', [('id', 'int64'), ('user', 'dict'), ('uid', 'int64'), ('version', 'int32'),
+                     ('changeset', 'int64'), ('timestamp', 'timestamp')]),
+    ('ways_nodes', 'way_nodes', [('id', 'int64'), ('node_id', 'int64'), ('position', 'int32')]),
+    ('ways_tags', 'way_tags', [('id', 'int64'), ('key', 'dict'), ('value', 'string'), ('type', 'dict')]),
+    ('relations', 'relation', [('id', 'int64'), ('user', 'dict'), ('uid', 'int64'), ('version', 'int32'),
+                               ('changeset', 'int64'), ('timestamp', 'timestamp')]),
+    ('relations_members', 'relation_members', [('id', 'int64'), ('member_id', 'int64'), ('member_type', 'dict'),
+                                               ('role', 'string'), ('position', 'int32')]),
+    ('relations_tags', 'relation_tags', [('id', 'int64'), ('key', 'dict'), ('value', 'string'), ('type', 'dict')]),
+]
+
+
+# Kinds stored as 8 byte integers, buffered with node_store.int64s: array may have no
+# 8 byte typecode (Python 2, Windows)
+INT64_KINDS = ('int64', 'timestamp', 'string')
+
+
+def _new_buffer(kind):
+    """Return an empty buffer for the values of a column kind"""
+    if kind in INT64_KINDS:
+        return int64s()
+    return array.array('d' if kind == 'float64' else 'i')
+
+
+_BYTE_ORDER = '<' if sys.byteorder == 'little' else '>'
+_DESCR = {'int64': 'i8', 'timestamp': 'i8', 'int32': 'i4', 'dict': 'i4', 'float64': 'f8', 'string': 'i8'}
+# Fixed .npy header size, so the header can be rewritten with the final length on close
+_HEADER_SIZE = 128
+
+
+def _npy_header(kind, length):
+    """Build a version 1.0 .npy header for a 1-d column of the given length"""
+    header = "{{'descr': '{0}{1}', 'fortran_order': False, 'shape': ({2},), }}".format(
+        _BYTE_ORDER, _DESCR[kind], length)
+    header = header.ljust(_HEADER_SIZE - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('ascii')
+
+
+def parse_timestamp(timestamp):
+    """Convert an OSM timestamp (2017-01-01T00:00:00Z) to seconds since the epoch"""
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+class ColumnWriter(object):
+    """Append typed values to a .npy file, through a buffer flushed in blocks"""
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.length = 0
+        self.buffer = _new_buffer(kind)
+        self.file = open(path, 'wb')
+        self.file.write(_npy_header(kind, 0))
+        if kind == 'dict':
+            self.codes = {}
+            self.values = []
+        elif kind == 'string':
+            self.text = open(path[:-len('.npy')] + '.utf8', 'wb')
+            self.offset = 0
+            self.buffer.append(0)
+        convert = {'int64': int, 'int32': int, 'float64': float, 'timestamp': parse_timestamp,
+                   'string': self._write_text}
+        self.convert = convert.get(kind, self._encode)
+
+    def _write_text(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        self.text.write(value)
+        self.offset += len(value)
+        return self.offset
+
+    def _encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def append(self, value):
+        self.buffer.append(self.convert(value))
+        if len(self.buffer) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.kind in INT64_KINDS:
+            write_int64s(self.buffer, self.file)
+        else:
+            self.buffer.tofile(self.file)
+        self.length += len(self.buffer)
+        self.buffer = _new_buffer(self.kind)
+
+    def close(self):
+        self.flush()
+        self.file.seek(0)
+        self.file.write(_npy_header(self.kind, self.length))
+        self.file.close()
+        if self.kind == 'string':
+            self.text.close()
+        elif self.kind == 'dict':
+            with io.open(self.path[:-len('.npy')] + '.dict.json', 'wb') as f:
+                f.write(json.dumps(self.values, ensure_ascii=False).encode('utf-8'))
+
+
+class ColumnarSink(object):
+    """Write shaped elements to one ColumnWriter per table column"""
+
+    def __init__(self, out_dir=COLUMNAR_DIR):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.tables = {}
+        for table, field, columns in TABLES:
+            self.tables[field] = [(name, ColumnWriter(os.path.join(out_dir, '{0}.{1}.npy'.format(table, name)),
+                                                      kind)) for name, kind in columns]
+
+    def _add(self, field, records):
+        for name, writer in self.tables[field]:
+            for record in records:
+                writer.append(record[name])
+
+    def write(self, el):
+        if 'node' in el:
+            self._add('node', [el['node']])
+            self._add('node_tags', el['node_tags'])
+        elif 'way' in el:
+            self._add('way', [el['way']])
+            self._add('way_nodes', el['way_nodes'])
+            self._add('way_tags', el['way_tags'])
+        elif 'relation' in el:
+            self._add('relation', [el['relation']])
+            self._add('relation_members', el['relation_members'])
+            self._add('relation_tags', el['relation_tags'])
+
+    def close(self):
+        for columns in self.tables.values():
+            for _, writer in columns:
+                writer.close()
+
+
+# Function to clean the OSM file and write it as typed columns
+def process_map_columnar(file_in, out_dir=COLUMNAR_DIR, validate=False, backend=osm_reader.DEFAULT_BACKEND,
+                         clean='element'):
+    sink = ColumnarSink(out_dir)
+    try:
+        elements = get_element(file_in, tags=ELEMENT_TAGS, backend=backend)
+        for el in validate_elements(shape_elements(elements, clean), validate):
+            sink.write(el)
+    finally:
+        sink.close()
+
+
+class StringColumn(object):
+    """Memory-mapped string column, indexing it decodes one value"""
+
+    def __init__(self, offsets, text):
+        self.offsets = offsets
+        self.text = text
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1]].tostring().decode('utf-8')
+
+
+# Function to memory-map the columns of a table, returns (columns, dictionaries), string
+# columns being StringColumn objects. Needs numpy, unlike the writer
+def load_columns(table, out_dir=COLUMNAR_DIR):
+    import numpy as np
+    for name, _, columns in TABLES:
+        if name == table:
+            break
+    else:
+        raise ValueError("Unknown table '{0}'".format(table))
+
+    arrays = {}
+    dictionaries = {}
+    for column, kind in columns:
+        path = os.path.join(out_dir, '{0}.{1}.npy'.format(table, column))
+        arrays[column] = np.load(path, mmap_mode='r')
+        if kind == 'string':
+            text_path = path[:-len('.npy')] + '.utf8'
+            # numpy cannot memory-map an empty file
+            text = np.memmap(text_path, dtype=np.uint8, mode='r') if os.path.getsize(text_path) else \
+                np.zeros(0, dtype=np.uint8)
+            arrays[column] = StringColumn(arrays[column], text)
+        elif kind == 'dict':
+            with io.open(path[:-len('.npy')] + '.dict.json', 'rb') as f:
+                dictionaries[column] = json.loads(f.read().decode('utf-8'))
+    return arrays, dictionaries
+
+
+if __name__ == '__main__':
+    process_map_columnar(OSM_PATH)
@@ -1,17 +1,14 @@
 import sqlite3
 import csv
+import itertools
+import time
 
+import profiling
+from db_indexes import build_indexes
+from spatial_index import build_spatial_index
 
-# Scrip to convert CSV files to SQL database
-def main():
-    sqlite_file = 'bristol.db'
-    conn = sqlite3.connect(sqlite_file)
-    conn.text_factory = str
-
-    cur = conn.cursor()
-
-    # Create node table and insert data from nodes.csv
-    cur.execute('''
+# Table definitions and insert statements, shared with osm_to_sql.py
+NODE_TABLE = '''
         CREATE TABLE node (
             id INTEGER PRIMARY KEY,
             lat REAL,
@@ -22,43 +19,16 @@ def main():
             changeset INTEGER,
             timestamp TEXT
             );
-            ''')
-
-    conn.commit()
-
-    with open('nodes.csv', 'rt') as f:
-        dr = csv.DictReader(f)
-        to_db = [(i['id'], i['lat'], i['lon'], i['user'].decode('utf-8'), i['uid'], i['version'], i['changeset'],
-                  i['timestamp']) for i in dr]
-
-    cur.executemany(
-        'INSERT INTO node(id, lat, lon, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
-        to_db)
-
-    conn.commit()
-
-    # Create node_tags table and insert data from nodes_tags.csv
-    cur.execute('''
+            '''
+NODE_TAGS_TABLE = '''
         CREATE TABLE node_tags (
             id INTEGER REFERENCES node (id),
             key TEXT,
             value TEXT,
             type TEXT
             );
-            ''')
-
-    conn.commit()
-
-    with open('nodes_tags.csv', 'rt') as f:
-        dr = csv.DictReader(f)
-        to_db = [(i['id'], i['key'], i['value'].decode('utf-8'), i['type']) for i in dr]
-
-    cur.executemany('INSERT INTO node_tags(id, key, value, type) VALUES (?, ?, ?, ?);', to_db)
-
-    conn.commit()
-
-    # Create way table and insert data from ways.csv
-    cur.execute('''
+            '''
+WAY_TABLE = '''
         CREATE TABLE way (
             id INTEGER PRIMARY KEY,
             user TEXT,
@@ -67,58 +37,169 @@ def main():
             changeset INTEGER,
             timestamp TEXT
             );
-            ''')
-
-    conn.commit()
-
-    with open('ways.csv', 'rt') as f:
-        dr = csv.DictReader(f)
-        to_db = [(i['id'], i['user'].decode('utf-8'), i['uid'], i['version'], i['changeset'], i['timestamp']) for i in
-                 dr]
-
-    cur.executemany('INSERT INTO way(id, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?);', to_db)
-
-    conn.commit()
-
-    # Create way_nodes table and insert data from ways_nodes.csv
-    cur.execute('''
+            '''
+WAY_NODES_TABLE = '''
         CREATE TABLE way_nodes (
             id INTEGER REFERENCES way (id),
             node_id INTEGER,
             position INTEGER
             );
-            ''')
-
-    conn.commit()
-
-    with open('ways_nodes.csv', 'rt') as f:
-        dr = csv.DictReader(f)
-        to_db = [(i['id'], i['node_id'], i['position']) for i in dr]
-
-    cur.executemany('INSERT INTO way_nodes(id, node_id, position) VALUES (?, ?, ?);', to_db)
-
-    conn.commit()
-
-    # Create way_tags table and insert data from ways_tags.csv
-    cur.execute('''
+            '''
+WAY_TAGS_TABLE = '''
         CREATE TABLE way_tags (
             id INTEGER REFERENCES way (id),
             key TEXT,
             value TEXT,
             type TEXT
             );
-            ''')
-
+            '''
+RELATION_TABLE = '''
+        CREATE TABLE relation (
+            id INTEGER PRIMARY KEY,
+            user TEXT,
+            uid INTEGER,
+            version TEXT,
+            changeset INTEGER,
+            timestamp TEXT
+            );
+            '''
+RELATION_MEMBERS_TABLE = '''
+        CREATE TABLE relation_members (
+            id INTEGER REFERENCES relation (id),
+            member_id INTEGER,
+            member_type TEXT,
+            role TEXT,
+            position INTEGER
+            );
+            '''
+RELATION_TAGS_TABLE = '''
+        CREATE TABLE relation_tags (
+            id INTEGER REFERENCES relation (id),
+            key TEXT,
+            value TEXT,
+            type TEXT
+            );
+            '''
+
+NODE_INSERT = 'INSERT INTO node(id, lat, lon, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);'
+NODE_TAGS_INSERT = 'INSERT INTO node_tags(id, key, value, type) VALUES (?, ?, ?, ?);'
+WAY_INSERT = 'INSERT INTO way(id, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?);'
+WAY_NODES_INSERT = 'INSERT INTO way_nodes(id, node_id, position) VALUES (?, ?, ?);'
+WAY_TAGS_INSERT = 'INSERT INTO way_tags(id, key, value, type) VALUES (?, ?, ?, ?);'
+RELATION_INSERT = 'INSERT INTO relation(id, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?);'
+RELATION_MEMBERS_INSERT = 'INSERT INTO relation_members(id, member_id, member_type, role, position) ' \
+                          'VALUES (?, ?, ?, ?, ?);'
+RELATION_TAGS_INSERT = 'INSERT INTO relation_tags(id, key, value, type) VALUES (?, ?, ?, ?);'
+
+
+# Rows per executemany call and per commit
+BATCH_SIZE = 50000
+
+# Pragmas used while bulk loading: no rollback journal, no fsync and a ~200 MB page cache.
+# A crash during the load leaves a corrupt database, which is simply rebuilt.
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = OFF;',
+    'PRAGMA synchronous = OFF;',
+    'PRAGMA cache_size = -200000;',
+]
+
+# Function to apply the bulk load pragmas to a connection
+def set_bulk_load_pragmas(conn):
+    for pragma in BULK_LOAD_PRAGMAS:
+        conn.execute(pragma)
+
+
+# Function yielding one row per line of a CSV file, converted by to_row
+def read_rows(csv_path, to_row):
+    with open(csv_path, 'rt') as f:
+        for i in csv.DictReader(f):
+            yield to_row(i)
+
+
+# Function splitting a stream of rows into lists of at most batch_size rows
+def batches(rows, batch_size=BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+# Function to create a table and stream the rows of a CSV file into it, one commit per batch
+def load_table(conn, create, insert, csv_path, to_row, batch_size=BATCH_SIZE):
+    cur = conn.cursor()
+    cur.execute(create)
     conn.commit()
 
-    with open('ways_tags.csv', 'rt') as f:
-        dr = csv.DictReader(f)
-        to_db = [(i['id'].decode('utf-8'), i['key'], i['value'].decode('utf-8'), i['type']) for i in dr]
+    profiler = profiling.current()
+    # Table name, from "INSERT INTO <table>(...)"
+    table = insert.split()[2].split('(')[0]
+    start = time.time()
+    count = 0
+    rows = batches(read_rows(csv_path, to_row), batch_size)
+    if profiler is not None:
+        rows = profiler.timed('csv_read:' + table, rows)
+    for batch in rows:
+        insert_start = time.time()
+        cur.executemany(insert, batch)
+        conn.commit()
+        count += len(batch)
+        if profiler is not None:
+            profiler.add_time('sql_insert:' + table, time.time() - insert_start)
+    elapsed = time.time() - start
+    if profiler is not None:
+        profiler.count('sql_rows:' + table, count)
+    print('{0}: {1} rows in {2:.1f}s ({3:.0f} rows/sec)'.format(csv_path, count, elapsed,
+                                                                count / elapsed if elapsed else 0))
+    return count
 
-    cur.executemany('INSERT INTO way_tags(id, key, value, type) VALUES (?, ?, ?, ?);', to_db)
 
-    conn.commit()
+# Scrip to convert CSV files to SQL database
+def main(sqlite_file='bristol.db', batch_size=BATCH_SIZE):
+    conn = sqlite3.connect(sqlite_file)
+    conn.text_factory = str
+    set_bulk_load_pragmas(conn)
+
+    # Create node table and insert data from nodes.csv
+    load_table(conn, NODE_TABLE, NODE_INSERT, 'nodes.csv',
+               lambda i: (i['id'], i['lat'], i['lon'], i['user'].decode('utf-8'), i['uid'], i['version'],
+                          i['changeset'], i['timestamp']), batch_size)
+
+    # Create node_tags table and insert data from nodes_tags.csv
+    load_table(conn, NODE_TAGS_TABLE, NODE_TAGS_INSERT, 'nodes_tags.csv',
+               lambda i: (i['id'], i['key'], i['value'].decode('utf-8'), i['type']), batch_size)
+
+    # Create way table and insert data from ways.csv
+    load_table(conn, WAY_TABLE, WAY_INSERT, 'ways.csv',
+               lambda i: (i['id'], i['user'].decode('utf-8'), i['uid'], i['version'], i['changeset'],
+                          i['timestamp']), batch_size)
+
+    # Create way_nodes table and insert data from ways_nodes.csv
+    load_table(conn, WAY_NODES_TABLE, WAY_NODES_INSERT, 'ways_nodes.csv',
+               lambda i: (i['id'], i['node_id'], i['position']), batch_size)
 
+    # Create way_tags table and insert data from ways_tags.csv
+    load_table(conn, WAY_TAGS_TABLE, WAY_TAGS_INSERT, 'ways_tags.csv',
+               lambda i: (i['id'].decode('utf-8'), i['key'], i['value'].decode('utf-8'), i['type']), batch_size)
+
+    # Create relation table and insert data from relations.csv
+    load_table(conn, RELATION_TABLE, RELATION_INSERT, 'relations.csv',
+               lambda i: (i['id'], i['user'].decode('utf-8'), i['uid'], i['version'], i['changeset'],
+                          i['timestamp']), batch_size)
+
+    # Create relation_members table and insert data from relations_members.csv
+    load_table(conn, RELATION_MEMBERS_TABLE, RELATION_MEMBERS_INSERT, 'relations_members.csv',
+               lambda i: (i['id'], i['member_id'], i['member_type'], i['role'].decode('utf-8'), i['position']),
+               batch_size)
+
+    # Create relation_tags table and insert data from relations_tags.csv
+    load_table(conn, RELATION_TAGS_TABLE, RELATION_TAGS_INSERT, 'relations_tags.csv',
+               lambda i: (i['id'], i['key'], i['value'].decode('utf-8'), i['type']), batch_size)
+
+    # Indexes are only created once all the data is in, faster than updating them row by row
+    profiling.timed_stage('sql_indexes', build_indexes, conn)
+    profiling.timed_stage('sql_spatial_index', build_spatial_index, conn)
     conn.close()
 
 
@@ -0,0 +1,172 @@
+import re
+import sqlite3
+
+# Script to build the secondary indexes of the SQL database once the tables are loaded,
+# and to check with EXPLAIN QUERY PLAN that the reference queries below use them
+# instead of scanning whole tables.
+SQLITE_FILE = 'bristol.db'
+
+# Covering indexes for the common access patterns: tags looked up by element id or
+# filtered by key/value, way nodes and relation members read in order, and the ways
+# using a node or relations using an element
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS node_tags_id ON node_tags (id);',
+    'CREATE INDEX IF NOT EXISTS node_tags_key_value ON node_tags (key, value, id);',
+    'CREATE INDEX IF NOT EXISTS way_tags_id ON way_tags (id);',
+    'CREATE INDEX IF NOT EXISTS way_tags_key_value ON way_tags (key, value, id);',
+    'CREATE INDEX IF NOT EXISTS way_nodes_id_position ON way_nodes (id, position, node_id);',
+    'CREATE INDEX IF NOT EXISTS way_nodes_node_id ON way_nodes (node_id, id);',
+    'CREATE INDEX IF NOT EXISTS relation_tags_id ON relation_tags (id);',
+    'CREATE INDEX IF NOT EXISTS relation_tags_key_value ON relation_tags (key, value, id);',
+    'CREATE INDEX IF NOT EXISTS relation_members_id_position ON relation_members (id, position);',
+    'CREATE INDEX IF NOT EXISTS relation_members_member ON relation_members (member_type, member_id, id);',
+]
+
+# Reference queries: (name, sql, parameters, indexes the plan is expected to use)
+REFERENCE_QUERIES = [
+    ('node_tags_by_id',
+     'SELECT key, value, type FROM node_tags WHERE id = ?;', (1,),
+     ['node_tags_id']),
+    ('way_tags_by_id',
+     'SELECT key, value, type FROM way_tags WHERE id = ?;', (1,),
+     ['way_tags_id']),
+    ('way_node_list',
+     'SELECT node_id FROM way_nodes WHERE id = ? ORDER BY position;', (1,),
+     ['way_nodes_id_position']),
+    ('ways_using_node',
+     'SELECT id FROM way_nodes WHERE node_id = ?;', (1,),
+     ['way_nodes_node_id']),
+    ('relation_member_list',
+     'SELECT member_type, member_id, role FROM relation_members WHERE id = ? ORDER BY position;', (1,),
+     ['relation_members_id_position']),
+    ('relations_using_way',
+     'SELECT id, role FROM relation_members WHERE member_type = ? AND member_id = ?;', ('way', 1),
+     ['relation_members_member']),
+    ('relations_by_type',
+     'SELECT id FROM relation_tags WHERE key = ? AND value = ?;', ('type', 'restriction'),
+     ['relation_tags_key_value']),
+    ('top_amenities',
+     'SELECT value, COUNT(*) as count '
+     'FROM (SELECT value FROM way_tags WHERE key = ? UNION ALL '
+     'SELECT value FROM node_tags WHERE key = ?) '
+     'GROUP BY value ORDER BY count DESC;', ('amenity', 'amenity'),
+     ['way_tags_key_value', 'node_tags_key_value']),
+    ('top_post_codes',
+     'SELECT value, COUNT(*) as count '
+     'FROM (SELECT value FROM way_tags WHERE key IN (?, ?) UNION ALL '
+     'SELECT value FROM node_tags WHERE key IN (?, ?)) '
+     'GROUP BY value ORDER BY count DESC;', ('postcode', 'postal_code', 'postcode', 'postal_code'),
+     ['way_tags_key_value', 'node_tags_key_value']),
+    ('nodes_with_amenity',
+     'SELECT n.id, n.lat, n.lon FROM node_tags t JOIN node n ON n.id = t.id '
+     'WHERE t.key = ? AND t.value = ?;', ('amenity', 'cafe'),
+     ['node_tags_key_value']),
+    ('restaurant_cuisines',
+     'SELECT c.value, COUNT(*) as num FROM node_tags r JOIN node_tags c ON c.id = r.id '
+     'WHERE r.key = ? AND r.value = ? AND c.key = ? '
+     'GROUP BY c.value ORDER BY num DESC;', ('amenity', 'restaurant', 'cuisine'),
+     ['node_tags_key_value']),
+]
+
+# sqlite_stat1 rows of a city sized extract: (table, index, stat), stat being the
+# number of rows followed by the average number of rows per value of each prefix of
+# the index columns. The planner picks its plans from these statistics, and on a
+# small extract ANALYZE makes a full scan the cheaper plan for some of the reference
+# queries: the plans are checked against these pinned figures, see reference_database.
+REFERENCE_STATS = [
+    ('node', None, '1000000'),
+    ('node_tags', 'node_tags_id', '300000 3'),
+    ('node_tags', 'node_tags_key_value', '300000 3000 20 1'),
+    ('way', None, '150000'),
+    ('way_tags', 'way_tags_id', '450000 3'),
+    ('way_tags', 'way_tags_key_value', '450000 2000 30 1'),
+    ('way_nodes', 'way_nodes_id_position', '1200000 8 1 1'),
+    ('way_nodes', 'way_nodes_node_id', '1200000 2 1'),
+    ('relation', None, '3000'),
+    ('relation_tags', 'relation_tags_id', '12000 4'),
+    ('relation_tags', 'relation_tags_key_value', '12000 200 20 1'),
+    ('relation_members', 'relation_members_id_position', '60000 20 1'),
+    ('relation_members', 'relation_members_member', '60000 20000 2 1'),
+]
+
+# Plan step reading a whole table, e.g. "SCAN node_tags", "SCAN t" or "SCAN TABLE node_tags AS t"
+# (older SQLite versions), but not a scan of a subquery result
+FULL_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(?!SUBQUERY|CONSTANT ROW|\()')
+
+
+# Function to create the indexes and refresh the statistics used by the query planner
+def build_indexes(conn, indexes=INDEXES, analyze=True):
+    for index in indexes:
+        conn.execute(index)
+    if analyze:
+        conn.execute('ANALYZE;')
+    conn.commit()
+
+
+# Function to replace the planner statistics of a database with the given sqlite_stat1 rows
+def pin_statistics(conn, stats=REFERENCE_STATS):
+    # ANALYZE creates sqlite_stat1, on empty tables it adds no rows
+    conn.execute('ANALYZE;')
+    conn.execute('DELETE FROM sqlite_stat1;')
+    conn.executemany('INSERT INTO sqlite_stat1(tbl, idx, stat) VALUES (?, ?, ?);', stats)
+    # Makes the planner reload the statistics
+    conn.execute('ANALYZE sqlite_master;')
+    conn.commit()
+
+
+# Function returning an in-memory database with the tables and indexes of the SQL
+# database, no rows and the REFERENCE_STATS statistics, to check the query plans on
+def reference_database(indexes=INDEXES, stats=REFERENCE_STATS):
+    # Imported here, csv_to_sql imports this module
+    from csv_to_sql import NODE_TABLE, NODE_TAGS_TABLE, WAY_TABLE, WAY_NODES_TABLE, WAY_TAGS_TABLE, \
+        RELATION_TABLE, RELATION_MEMBERS_TABLE, RELATION_TAGS_TABLE
+    conn = sqlite3.connect(':memory:')
+    for table in [NODE_TABLE, NODE_TAGS_TABLE, WAY_TABLE, WAY_NODES_TABLE, WAY_TAGS_TABLE,
+                  RELATION_TABLE, RELATION_MEMBERS_TABLE, RELATION_TAGS_TABLE]:
+        conn.execute(table)
+    build_indexes(conn, indexes, analyze=False)
+    pin_statistics(conn, stats)
+    return conn
+
+
+# Function returning the EXPLAIN QUERY PLAN details of a query
+def query_plan(conn, sql, params=()):
+    return [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+# Function to check every reference query: no full table scans and the expected
+# indexes used. Returns a list of problems, empty when all the plans are fine.
+def check_query_plans(conn, queries=REFERENCE_QUERIES):
+    problems = []
+    for name, sql, params, expected in queries:
+        plan = query_plan(conn, sql, params)
+        for detail in plan:
+            if FULL_SCAN_RE.match(detail) and 'USING' not in detail:
+                problems.append('{0}: full scan ({1})'.format(name, detail))
+        for index in expected:
+            if not any(index in detail for detail in plan):
+                problems.append('{0}: index {1} not used\n    {2}'.format(name, index, '\n    '.join(plan)))
+    return problems
+
+
+# Function raising an exception when a reference query regressed to a full scan
+def verify_query_plans(conn, queries=REFERENCE_QUERIES):
+    problems = check_query_plans(conn, queries)
+    if problems:
+        raise Exception('Query plan regressions:\n' + '\n'.join(problems))
+
+
+if __name__ == '__main__':
+    # The indexes and queries are verified against the pinned statistics, the plans of
+    # the database itself depend on how much data it holds and are only reported
+    reference = reference_database()
+    verify_query_plans(reference)
+    reference.close()
+
+    conn = sqlite3.connect(SQLITE_FILE)
+    build_indexes(conn)
+    for name, sql, params, _ in REFERENCE_QUERIES:
+        print('{0}:\n    {1}'.format(name, '\n    '.join(query_plan(conn, sql, params))))
+    for problem in check_query_plans(conn):
+        print('Note, with the statistics of {0}: {1}'.format(SQLITE_FILE, problem))
+    conn.close()
@@ -0,0 +1,253 @@
+import bz2
+import collections
+import errno
+import multiprocessing
+import os
+import re
+import subprocess
+import zlib
+
+# Transparent reading of compressed OSM files (.osm.bz2, .osm.gz, .osm.xz), as
+# downloaded from Geofabrik, without decompressing them to disk first.
+#
+# open_osm returns a file object of the decompressed XML for any of the readers.
+# Decompression runs in a separate process writing into a pipe, so it overlaps with
+# parsing in the parent:
+#   .bz2 - multi-stream files (pbzip2, lbzip2 -n) are cut at stream boundaries and the
+#          streams are decompressed by a pool of workers, written to the pipe in file
+#          order. Single stream files are decompressed in the one child process.
+#   .gz  - zlib in a child process, concatenated members included
+#   .xz  - the xz command line tool (Python 2 has no lzma module)
+#
+# Readers that need byte offsets into the file (prepare_database with workers > 1 or
+# a checkpoint, tag_index, the byte_range sample) refuse compressed input.
+COMPRESSED_SUFFIXES = ('.bz2', '.gz', '.xz')
+
+# Compressed bytes read at a time
+READ_SIZE = 1024 * 1024
+# Compressed bytes per bz2 decompression task, consecutive streams are grouped up to it
+BZ2_TASK_SIZE = 1024 * 1024
+# Start of a bz2 stream holding at least one block: "BZh", the block size digit and
+# the block magic, which is only byte-aligned right after a stream header
+BZ2_STREAM_START = re.compile(br'BZh[1-9]1AY&SY')
+# Worker processes decompressing bz2 streams, None for all cpus but the parser's one
+DECOMPRESS_WORKERS = None
+
+
+# Function returning True when the file name has one of the compressed suffixes
+def is_compressed(path):
+    return isinstance(path, basestring) and path.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def open_osm(path, workers=DECOMPRESS_WORKERS):
+    """Open an OSM file for reading, decompressing it on the fly when it is compressed
+
+    workers is the number of processes decompressing multi-stream bz2 files.
+    """
+
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == '.bz2':
+        if workers is None:
+            workers = max(1, multiprocessing.cpu_count() - 1)
+        return _child_pipe(path, _write_bz2, workers)
+    if suffix == '.gz':
+        return _child_pipe(path, _write_gz)
+    if suffix == '.xz':
+        return _xz_pipe(path)
+    return open(path, 'rb')
+
+
+class DecompressedFile(object):
+    """Read end of the pipe fed by a decompressing process
+
+    Reading to the end checks that the process succeeded, a truncated or corrupt
+    file raises IOError instead of looking like the end of the data.
+    """
+
+    def __init__(self, name, f, wait):
+        self.name = name
+        self.file = f
+        self.wait = wait
+        self.closed = False
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if not data and size != 0:
+            self._check()
+        return data
+
+    def _check(self):
+        status = self.wait()
+        if status:
+            raise IOError("Decompressing {0} failed (exit status {1})".format(self.name, status))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Closing first makes a process still writing stop on a broken pipe
+        self.file.close()
+        self.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _child_pipe(path, target, *args):
+    """Start target(path, out, *args) in a child process, return the read end of its pipe"""
+
+    read_fd, write_fd = os.pipe()
+    # Not a daemon, the bz2 child starts a pool of its own
+    process = multiprocessing.Process(target=_run_writer, args=(target, path, read_fd, write_fd) + args)
+    process.start()
+    os.close(write_fd)
+
+    def wait():
+        process.join()
+        return process.exitcode
+
+    return DecompressedFile(path, os.fdopen(read_fd, 'rb'), wait)
+
+
+def _run_writer(target, path, read_fd, write_fd, *args):
+    os.close(read_fd)
+    out = os.fdopen(write_fd, 'wb')
+    try:
+        target(path, out, *args)
+        out.close()
+    except IOError as e:
+        # The reader closed the pipe before the end, nothing left to do
+        if e.errno != errno.EPIPE:
+            raise
+
+
+def _xz_pipe(path):
+    try:
+        process = subprocess.Popen(['xz', '--decompress', '--stdout', '--', path], stdout=subprocess.PIPE)
+    except OSError as e:
+        raise IOError("Reading {0} needs the xz command line tool: {1}".format(path, e))
+    # xz is killed by SIGPIPE when the reader stops early, not an error worth reporting
+    return DecompressedFile(path, process.stdout, lambda: 0 if process.wait() < 0 else process.returncode)
+
+
+def _write_gz(path, out):
+    """Decompress a gzip file into out, member after member"""
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            while data:
+                out.write(decompressor.decompress(data))
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out.write(decompressor.flush())
+
+
+def _bz2_stream_starts(path):
+    """Return the offsets of the bz2 streams of a file"""
+
+    # Reads overlap by one byte less than a stream start, so a stream start split
+    # between two reads is found exactly once
+    overlap = 9
+    starts = []
+    with open(path, 'rb') as f:
+        offset = 0
+        tail = b''
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            block = tail + data
+            base = offset - len(tail)
+            starts.extend(base + m.start() for m in BZ2_STREAM_START.finditer(block))
+            tail = block[-overlap:]
+            offset += len(data)
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return starts, offset
+
+
+def _bz2_tasks(path, task_size=BZ2_TASK_SIZE):
+    """Return the (start, end) byte ranges of a bz2 file, each a run of whole streams"""
+
+    starts, size = _bz2_stream_starts(path)
+    bounds = [0]
+    for start in starts[1:]:
+        if start - bounds[-1] >= task_size:
+            bounds.append(start)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def _decompress_bz2(data):
+    """Return the decompressed data of one or more whole bz2 streams"""
+
+    out = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        out.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return b''.join(out)
+
+
+def _decompress_bz2_range(args):
+    """Worker: decompress the streams in one byte range of a bz2 file"""
+
+    path, start, end = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return _decompress_bz2(f.read(end - start))
+
+
+def _write_bz2(path, out, workers):
+    """Decompress a bz2 file into out, in parallel when it has several streams"""
+
+    tasks = _bz2_tasks(path) if workers > 1 else []
+    if len(tasks) <= 1:
+        _write_bz2_serial(path, out)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # Keep a couple of tasks per worker in flight, written out in file order
+        pending = collections.deque()
+        for start, end in tasks:
+            pending.append(pool.apply_async(_decompress_bz2_range, ((path, start, end),)))
+            if len(pending) >= 2 * workers:
+                out.write(pending.popleft().get())
+        while pending:
+            out.write(pending.popleft().get())
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _write_bz2_serial(path, out):
+    """Decompress a bz2 file into out one read at a time, stream after stream"""
+
+    decompressor = bz2.BZ2Decompressor()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            while data:
+                try:
+                    out.write(decompressor.decompress(data))
+                except EOFError:
+                    # The last stream ended right at the end of the previous read
+                    decompressor = bz2.BZ2Decompressor()
+                    continue
+                data = decompressor.unused_data
+                if data:
+                    decompressor = bz2.BZ2Decompressor()
@@ -0,0 +1,122 @@
+import pprint
+
+import schema
+
+# Validation with Cerberus is ~10X slower than shaping, so loads usually run without
+# it. This script compiles schema.schema into plain Python checks (required and
+# unknown fields, int/float coercion, string type) that run in a tight loop, with a
+# sampled mode (validate every Nth element) and a per-batch mode that checks whole
+# columns of values at once.
+
+SCHEMA = schema.schema
+
+
+# Function to compile a schema into: field -> (is_list, record fields, required fields, rules)
+# where rules is a list of (field name, coerce function or None, must be a string)
+def compile_schema(schema=SCHEMA):
+    compiled = {}
+    for field, rules in schema.items():
+        is_list = rules['type'] == 'list'
+        record_schema = rules['schema']['schema'] if is_list else rules['schema']
+        fields = frozenset(record_schema)
+        required = frozenset(name for name, r in record_schema.items() if r.get('required'))
+        field_rules = [(name, r.get('coerce'), 'coerce' not in r and r.get('type') == 'string')
+                       for name, r in sorted(record_schema.items())]
+        compiled[field] = (is_list, fields, required, field_rules)
+    return compiled
+
+
+# Function returning the errors of one record, as {field name: [messages]}
+def _record_errors(record, fields, required, rules):
+    errors = {}
+    for name in required - set(record):
+        errors[name] = ['required field']
+    for name in set(record) - fields:
+        errors[name] = ['unknown field']
+    for name, coerce, is_string in rules:
+        if name not in record:
+            continue
+        if coerce is not None:
+            try:
+                coerce(record[name])
+            except (TypeError, ValueError) as e:
+                errors[name] = ["field '{0}' cannot be coerced: {1}".format(name, e)]
+        elif is_string and not isinstance(record[name], basestring):
+            errors[name] = ['must be of string type']
+    return errors
+
+
+def _raise(field, errors):
+    message_string = "\nElement of type '{0}' has the following errors:\n{1}"
+    raise Exception(message_string.format(field, pprint.pformat(errors)))
+
+
+class FastValidator(object):
+    """Validate shaped elements against the compiled schema
+
+    every=N only validates one element out of N (sampled mode), every=1 validates
+    them all. validate_batch checks a list of elements column by column.
+    """
+
+    def __init__(self, schema=SCHEMA, every=1):
+        self.compiled = compile_schema(schema)
+        self.every = every
+        self.seen = 0
+        self.validated = 0
+
+    def validate(self, element):
+        """Raise an Exception if element does not match the schema"""
+        self.seen += 1
+        if self.every > 1 and self.seen % self.every != 1:
+            return
+        self.validated += 1
+        for field, value in element.items():
+            try:
+                is_list, fields, required, rules = self.compiled[field]
+            except KeyError:
+                _raise(field, {field: ['unknown field']})
+            for record in (value if is_list else [value]):
+                errors = _record_errors(record, fields, required, rules)
+                if errors:
+                    _raise(field, errors)
+
+    def validate_batch(self, elements):
+        """Raise an Exception if any element of the batch does not match the schema"""
+        records = {}
+        for element in elements:
+            for field, value in element.items():
+                if field not in self.compiled:
+                    _raise(field, {field: ['unknown field']})
+                if self.compiled[field][0]:
+                    records.setdefault(field, []).extend(value)
+                else:
+                    records.setdefault(field, []).append(value)
+
+        for field, field_records in records.items():
+            is_list, fields, required, rules = self.compiled[field]
+            if not self._column_errors(field_records, fields, required, rules):
+                continue
+            # Something is wrong in this column, find and report the first bad record
+            for record in field_records:
+                errors = _record_errors(record, fields, required, rules)
+                if errors:
+                    _raise(field, errors)
+        self.seen += len(elements)
+        self.validated += len(elements)
+
+    @staticmethod
+    def _column_errors(field_records, fields, required, rules):
+        """Check a whole column of records at once, True when one of them is wrong"""
+        # Every record must have exactly the schema fields, then only the values need checking
+        if required != fields or not all(len(r) == len(fields) and fields.issuperset(r) for r in field_records):
+            return True
+        for name, coerce, is_string in rules:
+            if coerce is not None:
+                try:
+                    # map runs the coercion over the whole column without a Python level loop
+                    list(map(coerce, [r[name] for r in field_records]))
+                except (TypeError, ValueError):
+                    return True
+            elif is_string and not all(isinstance(r[name], basestring) for r in field_records):
+                return True
+        return False
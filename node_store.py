@@ -0,0 +1,294 @@
+import array
+import bisect
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
+
+# Compact on-disk node id -> (lat, lon) store, built by prepare_database.process_map
+# and read through mmap, so resolving way geometries never needs all the nodes as
+# Python objects. Coordinates are kept as int32 fixed point (1e-7 degree, the OSM
+# precision). Files use the native byte order of the machine that built them.
+#
+# Two layouts, picked when the store is finalized:
+#   sorted - <path>.ids (int64, ascending) and <path>.coords (lat, lon int32 pairs),
+#            looked up by binary search through a sparse in-memory index
+#   dense  - <path>.dense, the (lat, lon) pair of node id min_id + i at slot i,
+#            missing ids marked by MISSING, used when ids are dense enough that
+#            the slots take less room than the sorted ids and coordinates
+#
+# Nodes are written in the order of the OSM file. When it is not sorted by id (merged
+# or hand edited extracts), finalize_node_store sorts them first: runs of
+# SORT_RUN_SIZE nodes sorted in memory, then merged from temporary files. A node id
+# seen more than once keeps its last coordinates.
+IDS_SUFFIX = '.ids'
+COORDS_SUFFIX = '.coords'
+DENSE_SUFFIX = '.dense'
+META_SUFFIX = '.json'
+
+SCALE = 10000000
+MISSING = -2 ** 31
+# Dense layout when (max_id - min_id + 1) <= DENSE_RATIO * node count
+DENSE_RATIO = 2.0
+# Ids between two entries of the sparse index of the sorted layout
+INDEX_STRIDE = 128
+FLUSH_SIZE = 65536
+# Nodes sorted in memory at a time when a store written out of id order is sorted
+SORT_RUN_SIZE = 8 * FLUSH_SIZE
+# Record of the temporary run files: id, position in the input, lat, lon
+RUN_RECORD = struct.Struct('=qqii')
+
+
+def _int64_typecode():
+    """Return the array typecode of 8 byte integers, None when there is none
+
+    array has no 'q' in Python 2 and 'l' is 4 bytes on Windows: ids are then packed
+    with struct and held in lists.
+    """
+    for code in ('l', 'q'):
+        try:
+            if array.array(code).itemsize == 8:
+                return code
+        except ValueError:
+            pass
+    return None
+
+
+INT64 = _int64_typecode()
+ID_SIZE = 8
+COORD_SIZE = 8
+
+
+def int64s(values=()):
+    """Return a sequence of 8 byte integers, an array when possible"""
+    return array.array(INT64, values) if INT64 else list(values)
+
+
+def int64s_from_bytes(data):
+    """Return the 8 byte integers packed in native byte order in data"""
+    if INT64:
+        return array.array(INT64, data)
+    return list(struct.unpack('={0}q'.format(len(data) // ID_SIZE), data))
+
+
+def write_int64s(values, f):
+    """Write a sequence returned by int64s to a file, packed in native byte order"""
+    if INT64:
+        values.tofile(f)
+    else:
+        f.write(struct.pack('={0}q'.format(len(values)), *values))
+
+
+# Function returning the files written while the store is built, before finalize_node_store
+def node_store_files(path):
+    return [path + IDS_SUFFIX, path + COORDS_SUFFIX]
+
+
+class NodeStoreWriter(object):
+    """Append nodes to the sorted layout files of a store
+
+    Nodes out of id order are fine, finalize_node_store sorts them.
+    """
+
+    def __init__(self, path):
+        self.ids_file = open(path + IDS_SUFFIX, 'wb')
+        self.coords_file = open(path + COORDS_SUFFIX, 'wb')
+        self.ids = int64s()
+        self.coords = array.array('i')
+
+    def add(self, node_id, lat, lon):
+        self.add_fixed(int(node_id), int(round(float(lat) * SCALE)), int(round(float(lon) * SCALE)))
+
+    def add_fixed(self, node_id, lat, lon):
+        """Append a node with coordinates already in fixed point"""
+        self.ids.append(node_id)
+        self.coords.append(lat)
+        self.coords.append(lon)
+        if len(self.ids) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        write_int64s(self.ids, self.ids_file)
+        self.coords.tofile(self.coords_file)
+        self.ids = int64s()
+        self.coords = array.array('i')
+
+    def close(self):
+        self.flush()
+        self.ids_file.close()
+        self.coords_file.close()
+
+
+def _read_id(f, i):
+    f.seek(i * ID_SIZE)
+    return int64s_from_bytes(f.read(ID_SIZE))[0]
+
+
+def _ids_sorted(path):
+    """Return True when the ids of the sorted layout files are strictly ascending"""
+    last = None
+    with open(path + IDS_SUFFIX, 'rb') as ids_file:
+        while True:
+            ids = int64s_from_bytes(ids_file.read(FLUSH_SIZE * ID_SIZE))
+            if not ids:
+                return True
+            if last is not None and ids[0] <= last:
+                return False
+            if len(set(ids)) != len(ids) or sorted(ids) != list(ids):
+                return False
+            last = ids[-1]
+
+
+def _read_run(run_path):
+    """Yield the records of a temporary run file"""
+    with open(run_path, 'rb') as f:
+        while True:
+            data = f.read(FLUSH_SIZE * RUN_RECORD.size)
+            if not data:
+                break
+            for offset in range(0, len(data), RUN_RECORD.size):
+                yield RUN_RECORD.unpack_from(data, offset)
+
+
+def _sort_store(path, run_size=SORT_RUN_SIZE):
+    """Rewrite the sorted layout files of a store in ascending id order, without duplicates"""
+    run_paths = []
+    try:
+        position = 0
+        with open(path + IDS_SUFFIX, 'rb') as ids_file, open(path + COORDS_SUFFIX, 'rb') as coords_file:
+            while True:
+                ids = int64s_from_bytes(ids_file.read(run_size * ID_SIZE))
+                if not ids:
+                    break
+                coords = array.array('i', coords_file.read(len(ids) * COORD_SIZE))
+                # The input position sorts the versions of a node id in file order
+                records = sorted(itertools.izip(ids, itertools.count(position), coords[0::2], coords[1::2]))
+                position += len(ids)
+                run_paths.append('{0}.run{1}'.format(path, len(run_paths)))
+                with open(run_paths[-1], 'wb') as run_file:
+                    for start in range(0, len(records), FLUSH_SIZE):
+                        run_file.write(b''.join(RUN_RECORD.pack(*record)
+                                                for record in records[start:start + FLUSH_SIZE]))
+
+        writer = NodeStoreWriter(path)
+        previous = None
+        for record in heapq.merge(*[_read_run(run_path) for run_path in run_paths]):
+            # Only the last version of each node id is written
+            if previous is not None and record[0] != previous[0]:
+                writer.add_fixed(previous[0], previous[2], previous[3])
+            previous = record
+        if previous is not None:
+            writer.add_fixed(previous[0], previous[2], previous[3])
+        writer.close()
+    finally:
+        for run_path in run_paths:
+            if os.path.exists(run_path):
+                os.remove(run_path)
+
+
+# Function to finish a store once all the nodes are written: sorts the nodes when they
+# were not written in id order, picks the layout and writes <path>.json. Returns the metadata.
+def finalize_node_store(path, dense_ratio=DENSE_RATIO):
+    if not _ids_sorted(path):
+        _sort_store(path)
+    count = os.path.getsize(path + IDS_SUFFIX) // ID_SIZE
+    meta = {'count': count, 'layout': 'sorted', 'scale': SCALE, 'min_id': None, 'max_id': None}
+    if count:
+        with open(path + IDS_SUFFIX, 'rb') as ids_file:
+            meta['min_id'] = _read_id(ids_file, 0)
+            meta['max_id'] = _read_id(ids_file, count - 1)
+        if meta['max_id'] - meta['min_id'] + 1 <= dense_ratio * count:
+            _write_dense(path, meta['min_id'])
+            meta['layout'] = 'dense'
+    if os.path.exists(path + DENSE_SUFFIX) and meta['layout'] != 'dense':
+        os.remove(path + DENSE_SUFFIX)
+    with open(path + META_SUFFIX, 'wb') as f:
+        f.write(json.dumps(meta).encode('utf-8'))
+    return meta
+
+
+def _write_dense(path, min_id):
+    """Convert the sorted layout files to the dense layout, block by block"""
+    gap = array.array('i', [MISSING, MISSING])
+    next_id = min_id
+    with open(path + IDS_SUFFIX, 'rb') as ids_file, open(path + COORDS_SUFFIX, 'rb') as coords_file, \
+            open(path + DENSE_SUFFIX, 'wb') as dense_file:
+        while True:
+            ids = int64s_from_bytes(ids_file.read(FLUSH_SIZE * ID_SIZE))
+            if not ids:
+                break
+            coords = array.array('i', coords_file.read(len(ids) * COORD_SIZE))
+            if ids[0] == next_id and ids[-1] - ids[0] == len(ids) - 1:
+                # No gap in this block: the coordinates are already in slot order
+                coords.tofile(dense_file)
+            else:
+                out = array.array('i')
+                for i, node_id in enumerate(ids):
+                    out.extend(gap * (node_id - next_id))
+                    out.append(coords[2 * i])
+                    out.append(coords[2 * i + 1])
+                    next_id = node_id + 1
+                out.tofile(dense_file)
+            next_id = ids[-1] + 1
+    for name in node_store_files(path):
+        os.remove(name)
+
+
+def _map(file_path):
+    with open(file_path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class NodeStore(object):
+    """Read-only node id -> (lat, lon) lookups on a finalized store"""
+
+    def __init__(self, path):
+        with open(path + META_SUFFIX, 'rb') as f:
+            self.meta = json.loads(f.read().decode('utf-8'))
+        self.count = self.meta['count']
+        self.min_id = self.meta['min_id']
+        self.scale = float(self.meta['scale'])
+        if self.meta['layout'] == 'dense':
+            self.coords = _map(path + DENSE_SUFFIX)
+            self.span = len(self.coords) // COORD_SIZE
+            self.get = self._get_dense
+        else:
+            self.ids = _map(path + IDS_SUFFIX)
+            self.coords = _map(path + COORDS_SUFFIX)
+            # Every INDEX_STRIDE-th id, so a lookup only reads one small block of ids
+            self.index = int64s([struct.unpack_from('=q', self.ids, i * ID_SIZE)[0]
+                                  for i in range(0, self.count, INDEX_STRIDE)])
+            self.get = self._get_sorted
+
+    def _get_dense(self, node_id):
+        i = node_id - self.min_id
+        if 0 <= i < self.span:
+            lat, lon = struct.unpack_from('=ii', self.coords, i * COORD_SIZE)
+            if lat != MISSING:
+                return lat / self.scale, lon / self.scale
+        return None
+
+    def _get_sorted(self, node_id):
+        block = bisect.bisect_right(self.index, node_id) - 1
+        if block < 0:
+            return None
+        start = block * INDEX_STRIDE
+        ids = int64s_from_bytes(self.ids[start * ID_SIZE:min(start + INDEX_STRIDE, self.count) * ID_SIZE])
+        i = bisect.bisect_left(ids, node_id)
+        if i < len(ids) and ids[i] == node_id:
+            lat, lon = struct.unpack_from('=ii', self.coords, (start + i) * COORD_SIZE)
+            return lat / self.scale, lon / self.scale
+        return None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        for name in ('ids', 'coords'):
+            data = getattr(self, name, None)
+            if isinstance(data, mmap.mmap):
+                data.close()
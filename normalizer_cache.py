@@ -0,0 +1,108 @@
+# The update_* functions used to clean tag values are pure functions, called millions
+# of times on a few thousand distinct values. This cache sits in front of them so a
+# repeated value costs a dictionary lookup instead of a new normalization.
+
+import itertools
+import time
+
+DEFAULT_MAXSIZE = 100000
+
+
+class BoundedCache(object):
+    """Bounded least recently used cache in front of a one-argument function, with
+    hit/miss counters and the seconds spent in the function
+
+    Entries live in two generations of at most maxsize / 2 each. A hit in the current
+    generation is a single dict lookup, a hit in the previous one promotes the entry,
+    and when the current generation is full the previous one is dropped. This keeps
+    the values used recently without reordering entries on every hit. The cache does
+    not know about the mappings the function reads, call clear() after changing one.
+    """
+
+    def __init__(self, func, maxsize=DEFAULT_MAXSIZE):
+        self.func = func
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+        self._current = {}
+        self._previous = {}
+
+    def __call__(self, value):
+        try:
+            result = self._current[value]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return result
+
+        try:
+            result = self._previous.pop(value)
+            self.hits += 1
+        except KeyError:
+            # Only misses are timed, hits stay a plain lookup
+            start = time.time()
+            result = self.func(value)
+            self.seconds += time.time() - start
+            self.misses += 1
+        self._store(value, result)
+        return result
+
+    def map(self, values, batch_func):
+        """Return [self(value) for value in values], with the values missing from the
+        cache computed by a single batch_func call on the list of them
+
+        Counts the hits and misses of the one value calls: the first time a missing
+        value is seen is a miss, the next ones hits. seconds is the time in batch_func.
+        """
+        results = []
+        # Missing value -> positions in values, and the missing values in order
+        pending = {}
+        missing = []
+        for i, value in enumerate(values):
+            try:
+                result = self._current[value]
+            except KeyError:
+                try:
+                    result = self._previous.pop(value)
+                except KeyError:
+                    if value in pending:
+                        self.hits += 1
+                        pending[value].append(i)
+                    else:
+                        self.misses += 1
+                        pending[value] = [i]
+                        missing.append(value)
+                    results.append(None)
+                    continue
+                self._store(value, result)
+            self.hits += 1
+            results.append(result)
+
+        if missing:
+            start = time.time()
+            computed = batch_func(missing)
+            self.seconds += time.time() - start
+            for value, result in itertools.izip(missing, computed):
+                self._store(value, result)
+                for i in pending[value]:
+                    results[i] = result
+        return results
+
+    def _store(self, value, result):
+        if len(self._current) >= max(1, self.maxsize // 2):
+            self._previous = self._current
+            self._current = {}
+        self._current[value] = result
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'seconds': self.seconds,
+                'size': len(self._current) + len(self._previous), 'maxsize': self.maxsize}
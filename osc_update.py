@@ -0,0 +1,165 @@
+import sqlite3
+import time
+from collections import deque
+import xml.etree.cElementTree as ET
+
+from db_indexes import INDEXES
+from decompress import is_compressed, open_osm
+from osm_to_sql import SQLITE_FILE, TABLES
+from prepare_database import shape_element, validate_elements
+from spatial_index import has_spatial_index, update_spatial_index
+
+# Script to apply an OsmChange file (.osc, e.g. the daily diffs of an extract) to an
+# existing SQL database instead of rebuilding it. The <create>, <modify> and <delete>
+# blocks are streamed; created and modified elements are cleaned by
+# prepare_database.shape_element like a full load. The rows of an element are
+# replaced by deleting everything stored for its id and inserting the new version.
+# The whole file is applied in a single transaction: either every change is in, or
+# none of them. The R*Tree entries of the changed nodes and ways are refreshed in
+# the same transaction, see spatial_index.
+ACTIONS = ('create', 'modify', 'delete')
+
+# Tables holding the rows of each element type, the element table first
+ELEMENT_TABLES = {
+    'node': ['node', 'node_tags'],
+    'way': ['way', 'way_nodes', 'way_tags'],
+    'relation': ['relation', 'relation_members', 'relation_tags'],
+}
+
+# Elements buffered before their rows are written with executemany
+BATCH_SIZE = 10000
+
+
+# Function yielding (action, element) for each node, way and relation of an OsmChange
+# file, which can be compressed (the replication diffs are .osc.gz)
+def get_changes(osc_file):
+    if is_compressed(osc_file):
+        with open_osm(osc_file) as f:
+            for change in get_changes(f):
+                yield change
+        return
+    action = None
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    block = root
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ACTIONS:
+                action = elem.tag
+                block = elem
+        elif elem.tag in ELEMENT_TABLES:
+            yield action, elem
+            # Elements are children of their action block, not of the root
+            block.clear()
+        elif elem.tag in ACTIONS:
+            action = None
+            block = root
+            root.clear()
+
+
+class ChangeSink(object):
+    """Buffer the deletes and inserts of a change file and apply them with executemany"""
+
+    def __init__(self, conn, batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.fields = dict((name, fields) for name, _, _, fields in TABLES)
+        self.deleted = dict((element_type, []) for element_type in ELEMENT_TABLES)
+        self.pending_ids = dict((element_type, set()) for element_type in ELEMENT_TABLES)
+        self.rows = dict((name, []) for name in self.fields)
+        self.pending = 0
+        self.counts = dict((action, 0) for action in ACTIONS)
+
+    def write(self, action, element_type, element_id, el=None):
+        # An element changed twice in the file: its first version must be written
+        # before the delete of the second one runs
+        if element_id in self.pending_ids[element_type]:
+            self.flush()
+        self.pending_ids[element_type].add(element_id)
+        self.deleted[element_type].append((element_id,))
+        if el is not None:
+            for name, records in el.items():
+                fields = self.fields[name]
+                for record in (records if isinstance(records, list) else [records]):
+                    self.rows[name].append(tuple(record[f] for f in fields))
+        self.counts[action] += 1
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        cur = self.conn.cursor()
+        # Deletes first, so a modified element is replaced by its new rows
+        for element_type, tables in ELEMENT_TABLES.items():
+            if self.deleted[element_type]:
+                for table in tables:
+                    cur.executemany('DELETE FROM {0} WHERE id = ?;'.format(table), self.deleted[element_type])
+                self.deleted[element_type] = []
+                self.pending_ids[element_type] = set()
+        for name, _, insert, _ in TABLES:
+            if self.rows[name]:
+                cur.executemany(insert, self.rows[name])
+                self.rows[name] = []
+        self.pending = 0
+
+
+# Function to apply an OsmChange file to the SQL database, returns the number of
+# elements created, modified and deleted. validate takes the modes of
+# prepare_database.validate_elements.
+def apply_changes(osc_file, sqlite_file=SQLITE_FILE, validate='fast', batch_size=BATCH_SIZE):
+    conn = sqlite3.connect(sqlite_file)
+    conn.text_factory = str
+    # Deleting the old rows of an element looks them up by id
+    for index in INDEXES:
+        conn.execute(index)
+    conn.commit()
+
+    sink = ChangeSink(conn, batch_size)
+    changed = {'node': set(), 'way': set()}
+    # Changes read but not written yet: validate_elements may hold back a batch of
+    # shaped elements, the deletes between them wait with them to keep the file order
+    queued = deque()
+
+    def shaped_changes():
+        for action, element in get_changes(osc_file):
+            if action is None:
+                raise ValueError("<{0} id='{1}'> outside of a create, modify or delete block".format(
+                    element.tag, element.attrib.get('id')))
+            el = shape_element(element) if action != 'delete' else None
+            queued.append((action, element.tag, int(element.attrib['id']), el))
+            if el is not None:
+                yield el
+
+    def write_queued(until=None):
+        while queued:
+            action, element_type, element_id, el = queued.popleft()
+            sink.write(action, element_type, element_id, el)
+            if element_type in changed:
+                changed[element_type].add(element_id)
+            if until is not None and el is until:
+                return
+
+    start = time.time()
+    try:
+        for validated in validate_elements(shaped_changes(), validate):
+            write_queued(validated)
+        write_queued()
+        sink.flush()
+        if has_spatial_index(conn):
+            update_spatial_index(conn, changed['node'], changed['way'])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    print('{0}: {1} created, {2} modified, {3} deleted in {4:.1f}s'.format(
+        osc_file, sink.counts['create'], sink.counts['modify'], sink.counts['delete'], time.time() - start))
+    return sink.counts
+
+
+if __name__ == '__main__':
+    import sys
+    for path in sys.argv[1:]:
+        apply_changes(path)
@@ -0,0 +1,110 @@
+import sqlite3
+import time
+
+import osm_reader
+import profiling
+from csv_to_sql import NODE_TABLE, NODE_TAGS_TABLE, WAY_TABLE, WAY_NODES_TABLE, WAY_TAGS_TABLE, \
+    RELATION_TABLE, RELATION_MEMBERS_TABLE, RELATION_TAGS_TABLE, \
+    NODE_INSERT, NODE_TAGS_INSERT, WAY_INSERT, WAY_NODES_INSERT, WAY_TAGS_INSERT, \
+    RELATION_INSERT, RELATION_MEMBERS_INSERT, RELATION_TAGS_INSERT, set_bulk_load_pragmas
+from db_indexes import build_indexes
+from spatial_index import build_spatial_index
+from prepare_database import OSM_PATH, ELEMENT_TAGS, NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, \
+    WAY_NODES_FIELDS, WAY_TAGS_FIELDS, RELATION_FIELDS, RELATION_MEMBERS_FIELDS, RELATION_TAGS_FIELDS, \
+    get_element, shape_elements, validate_elements
+
+# Script to load the OSM file straight into the SQL database, without going through
+# the CSV files. Elements are cleaned by prepare_database.shape_element, then the
+# rows are inserted with executemany in batches, one transaction per batch.
+SQLITE_FILE = 'bristol.db'
+BATCH_SIZE = 50000
+
+# (table name, create statement, insert statement, fields in column order)
+TABLES = [
+    ('node', NODE_TABLE, NODE_INSERT, NODE_FIELDS),
+    ('node_tags', NODE_TAGS_TABLE, NODE_TAGS_INSERT, NODE_TAGS_FIELDS),
+    ('way', WAY_TABLE, WAY_INSERT, WAY_FIELDS),
+    ('way_nodes', WAY_NODES_TABLE, WAY_NODES_INSERT, WAY_NODES_FIELDS),
+    ('way_tags', WAY_TAGS_TABLE, WAY_TAGS_INSERT, WAY_TAGS_FIELDS),
+    ('relation', RELATION_TABLE, RELATION_INSERT, RELATION_FIELDS),
+    ('relation_members', RELATION_MEMBERS_TABLE, RELATION_MEMBERS_INSERT, RELATION_MEMBERS_FIELDS),
+    ('relation_tags', RELATION_TAGS_TABLE, RELATION_TAGS_INSERT, RELATION_TAGS_FIELDS),
+]
+
+
+class SqliteSink(object):
+    """Buffer shaped elements as rows and insert them in batched transactions"""
+
+    def __init__(self, conn, batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.fields = dict((name, fields) for name, _, _, fields in TABLES)
+        self.rows = dict((name, []) for name, _, _, _ in TABLES)
+        self.pending = 0
+
+    def create_tables(self):
+        for _, create, _, _ in TABLES:
+            self.conn.execute(create)
+        self.conn.commit()
+
+    def write(self, el):
+        if 'node' in el:
+            self._add('node', [el['node']])
+            self._add('node_tags', el['node_tags'])
+        elif 'way' in el:
+            self._add('way', [el['way']])
+            self._add('way_nodes', el['way_nodes'])
+            self._add('way_tags', el['way_tags'])
+        elif 'relation' in el:
+            self._add('relation', [el['relation']])
+            self._add('relation_members', el['relation_members'])
+            self._add('relation_tags', el['relation_tags'])
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def _add(self, name, records):
+        fields = self.fields[name]
+        self.rows[name].extend(tuple(record[f] for f in fields) for record in records)
+        self.pending += len(records)
+
+    def flush(self):
+        profiler = profiling.current()
+        cur = self.conn.cursor()
+        for name, _, insert, _ in TABLES:
+            if self.rows[name]:
+                start = time.time()
+                cur.executemany(insert, self.rows[name])
+                if profiler is not None:
+                    profiler.add_time('sql_insert:' + name, time.time() - start)
+                    profiler.count('sql_rows:' + name, len(self.rows[name]))
+                self.rows[name] = []
+        self.conn.commit()
+        self.pending = 0
+
+
+# Function to clean the OSM file and insert it straight into a new SQL database
+def process_map_to_sql(file_in, sqlite_file=SQLITE_FILE, batch_size=BATCH_SIZE, validate=False,
+                       backend=osm_reader.DEFAULT_BACKEND, clean='element'):
+    conn = sqlite3.connect(sqlite_file)
+    conn.text_factory = str
+    set_bulk_load_pragmas(conn)
+    sink = SqliteSink(conn, batch_size)
+    sink.create_tables()
+
+    profiler = profiling.current()
+    elements = get_element(file_in, tags=ELEMENT_TAGS, backend=backend)
+    if profiler is None:
+        shaped = validate_elements(shape_elements(elements, clean), validate)
+    else:
+        shaped = profiler.timed('shape', shape_elements(profiler.timed('parse', elements), clean), inner='parse')
+        shaped = profiler.timed('validate', validate_elements(shaped, validate), inner='shape')
+    for el in shaped:
+        sink.write(el)
+    sink.flush()
+    profiling.timed_stage('sql_indexes', build_indexes, conn)
+    profiling.timed_stage('sql_spatial_index', build_spatial_index, conn)
+    conn.close()
+
+
+if __name__ == '__main__':
+    process_map_to_sql(OSM_PATH)
@@ -0,0 +1,442 @@
+import collections
+import multiprocessing
+import struct
+import time
+import zlib
+
+import osm_reader
+
+# Pure Python reader for OSM PBF files (.osm.pbf), the format extracts are
+# distributed in. It needs no protobuf package: the few messages of the format
+# (https://wiki.openstreetmap.org/wiki/PBF_Format) are decoded by hand.
+#
+# Elements are yielded as osm_reader.OsmElement objects with the same tag,
+# attributes and <tag>/<nd>/<member> children as the XML, so shape_element, the
+# auditors and sample.py handle them like any other element.
+# Dense nodes are supported. Coordinates are written with 7 decimals, timestamps
+# as in the XML.
+#
+# Each data block of a PBF file can be decoded on its own, so with workers > 1 the
+# blocks are decoded by a pool of processes and handed back in file order.
+PBF_SUFFIX = '.pbf'
+
+# Features of the OSMHeader block this reader can handle
+SUPPORTED_FEATURES = ('OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation')
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+# Function returning True for the file names of PBF files
+def is_pbf(path):
+    return isinstance(path, basestring) and path.lower().endswith(PBF_SUFFIX)
+
+
+def get_element(pbf_file, tags=('node', 'way', 'relation'), workers=1):
+    """Yield the elements of a PBF file whose tag is in tags"""
+
+    for record in _records(pbf_file, tags, workers):
+        yield _element(record)
+
+
+# ================================================== #
+#               Protobuf Wire Format                 #
+# ================================================== #
+def _varint(data, pos):
+    """Return the unsigned varint at pos of a bytearray and the position after it"""
+
+    b = data[pos]
+    if b < 0x80:
+        return b, pos + 1
+    result = b & 0x7f
+    shift = 7
+    pos += 1
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(data):
+    """Yield (field number, value) of each field of a message, in a bytearray
+
+    Varints are returned as unsigned integers, length delimited fields as bytearrays.
+    """
+
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = _varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = _varint(data, pos)
+        elif wire_type == 2:
+            size, pos = _varint(data, pos)
+            value = data[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {0}".format(wire_type))
+        yield key >> 3, value
+
+
+def _packed(data):
+    """Return the unsigned varints of a packed repeated field"""
+
+    values = []
+    append = values.append
+    result = 0
+    shift = 0
+    for b in data:
+        if b < 0x80:
+            append(result | (b << shift))
+            result = 0
+            shift = 0
+        else:
+            result |= (b & 0x7f) << shift
+            shift += 7
+    return values
+
+
+def _int64(value):
+    """Two's complement of an int64 (or int32) field, negative values take 10 bytes"""
+
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _sint(value):
+    """Decode a zigzag encoded sint32 / sint64 field"""
+
+    return (value >> 1) ^ -(value & 1)
+
+
+def _deltas(values):
+    """Decode a packed, zigzag and delta encoded field"""
+
+    out = []
+    append = out.append
+    total = 0
+    for value in values:
+        total += (value >> 1) ^ -(value & 1)
+        append(total)
+    return out
+
+
+# ================================================== #
+#               File and Block Decoding              #
+# ================================================== #
+def _blob_index(f):
+    """Return (blob type, offset, size) of each blob of a PBF file"""
+
+    blobs = []
+    while True:
+        head = f.read(4)
+        if not head:
+            return blobs
+        if len(head) < 4:
+            raise ValueError("Truncated PBF file")
+        header = f.read(struct.unpack('>I', head)[0])
+        blob_type = None
+        size = 0
+        for field, value in _fields(bytearray(header)):
+            if field == 1:
+                blob_type = bytes(value)
+            elif field == 3:
+                size = value
+        blobs.append((blob_type, f.tell(), size))
+        f.seek(size, 1)
+
+
+def _blob_data(blob):
+    """Return the uncompressed content of a Blob message"""
+
+    for field, value in _fields(bytearray(blob)):
+        if field == 1:
+            return bytes(value)
+        elif field == 3:
+            return zlib.decompress(bytes(value))
+        elif field in (4, 5, 6, 7):
+            raise ValueError("Unsupported PBF blob compression (field {0}), only zlib is".format(field))
+    return b''
+
+
+def _check_header(data):
+    for field, value in _fields(bytearray(data)):
+        if field == 4 and bytes(value) not in SUPPORTED_FEATURES:
+            raise ValueError("Unsupported PBF feature '{0}'".format(bytes(value)))
+
+
+class _Block(object):
+    """String table and coordinate / date scales of one PrimitiveBlock"""
+
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.date_granularity = 1000
+        self.lat_offset = 0
+        self.lon_offset = 0
+        for field, value in _fields(data):
+            if field == 1:
+                self.strings = [s.decode('utf-8') for _, s in _fields(value)]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = _int64(value)
+            elif field == 20:
+                self.lon_offset = _int64(value)
+        self.timestamps = {}
+
+    def coordinate(self, value, offset):
+        """Format a coordinate, in granularity units, as degrees with 7 decimals"""
+
+        nano = offset + self.granularity * value
+        degrees, units = divmod((abs(nano) + 50) // 100, 10000000)
+        return '%s%d.%07d' % ('-' if nano < 0 and (degrees or units) else '', degrees, units)
+
+    def timestamp(self, value):
+        try:
+            return self.timestamps[value]
+        except KeyError:
+            text = time.strftime(TIMESTAMP_FORMAT, time.gmtime(value * self.date_granularity // 1000))
+            self.timestamps[value] = text
+            return text
+
+    def tags(self, keys, values):
+        strings = self.strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, values)]
+
+    def info(self, attrib, data):
+        """Add the attributes of an Info message to attrib"""
+
+        for field, value in _fields(data):
+            if field == 1:
+                attrib['version'] = str(_int64(value))
+            elif field == 2:
+                attrib['timestamp'] = self.timestamp(value)
+            elif field == 3:
+                attrib['changeset'] = str(value)
+            elif field == 4:
+                attrib['uid'] = str(_int64(value))
+            elif field == 5:
+                attrib['user'] = self.strings[value]
+
+
+def _node(data, block):
+    attrib = {}
+    keys = values = ()
+    lat = lon = 0
+    for field, value in _fields(data):
+        if field == 1:
+            attrib['id'] = str(_sint(value))
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            values = _packed(value)
+        elif field == 4:
+            block.info(attrib, value)
+        elif field == 8:
+            lat = _sint(value)
+        elif field == 9:
+            lon = _sint(value)
+    attrib['lat'] = block.coordinate(lat, block.lat_offset)
+    attrib['lon'] = block.coordinate(lon, block.lon_offset)
+    return 'node', attrib, block.tags(keys, values), (), ()
+
+
+def _dense_nodes(data, block):
+    ids = lats = lons = keys_vals = ()
+    info = None
+    for field, value in _fields(data):
+        if field == 1:
+            ids = _deltas(_packed(value))
+        elif field == 5:
+            info = value
+        elif field == 8:
+            lats = _deltas(_packed(value))
+        elif field == 9:
+            lons = _deltas(_packed(value))
+        elif field == 10:
+            keys_vals = _packed(value)
+
+    versions = timestamps = changesets = uids = user_sids = None
+    if info is not None:
+        for field, value in _fields(info):
+            if field == 1:
+                versions = _packed(value)
+            elif field == 2:
+                timestamps = _deltas(_packed(value))
+            elif field == 3:
+                changesets = _deltas(_packed(value))
+            elif field == 4:
+                uids = _deltas(_packed(value))
+            elif field == 5:
+                user_sids = _deltas(_packed(value))
+
+    strings = block.strings
+    coordinate = block.coordinate
+    records = []
+    # keys_vals holds the key, value string ids of each node in turn, each node ended by a 0
+    kv = 0
+    for i, node_id in enumerate(ids):
+        attrib = {'id': str(node_id),
+                  'lat': coordinate(lats[i], block.lat_offset),
+                  'lon': coordinate(lons[i], block.lon_offset)}
+        if versions is not None:
+            attrib['version'] = str(versions[i])
+        if timestamps is not None:
+            attrib['timestamp'] = block.timestamp(timestamps[i])
+        if changesets is not None:
+            attrib['changeset'] = str(changesets[i])
+        if uids is not None:
+            attrib['uid'] = str(uids[i])
+        if user_sids is not None:
+            attrib['user'] = strings[user_sids[i]]
+        tags = []
+        if keys_vals:
+            while keys_vals[kv]:
+                tags.append((strings[keys_vals[kv]], strings[keys_vals[kv + 1]]))
+                kv += 2
+            kv += 1
+        records.append(('node', attrib, tags, (), ()))
+    return records
+
+
+def _way(data, block):
+    attrib = {}
+    keys = values = refs = ()
+    for field, value in _fields(data):
+        if field == 1:
+            attrib['id'] = str(_int64(value))
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            values = _packed(value)
+        elif field == 4:
+            block.info(attrib, value)
+        elif field == 8:
+            refs = _deltas(_packed(value))
+    return 'way', attrib, block.tags(keys, values), refs, ()
+
+
+def _relation(data, block):
+    attrib = {}
+    keys = values = roles = member_ids = types = ()
+    for field, value in _fields(data):
+        if field == 1:
+            attrib['id'] = str(_int64(value))
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            values = _packed(value)
+        elif field == 4:
+            block.info(attrib, value)
+        elif field == 8:
+            roles = _packed(value)
+        elif field == 9:
+            member_ids = _deltas(_packed(value))
+        elif field == 10:
+            types = _packed(value)
+    strings = block.strings
+    members = [(MEMBER_TYPES[t], ref, strings[role]) for t, ref, role in zip(types, member_ids, roles)]
+    return 'relation', attrib, block.tags(keys, values), (), members
+
+
+def _decode_block(blob, tags):
+    """Return the records of the elements of one OSMData blob whose tag is in tags
+
+    A record is (tag, attributes, [(k, v)], [node refs], [(member type, ref, role)]).
+    """
+
+    block = _Block(bytearray(_blob_data(blob)))
+    records = []
+    for group in block.groups:
+        for field, value in _fields(group):
+            if field == 1:
+                if 'node' in tags:
+                    records.append(_node(value, block))
+            elif field == 2:
+                if 'node' in tags:
+                    records.extend(_dense_nodes(value, block))
+            elif field == 3:
+                if 'way' in tags:
+                    records.append(_way(value, block))
+            elif field == 4:
+                if 'relation' in tags:
+                    records.append(_relation(value, block))
+    return records
+
+
+def _decode_block_at(args):
+    """Worker: decode the blob at offset of a PBF file"""
+
+    pbf_file, offset, size, tags = args
+    with open(pbf_file, 'rb') as f:
+        f.seek(offset)
+        return _decode_block(f.read(size), tags)
+
+
+def _records(pbf_file, tags, workers):
+    """Yield the records of the elements of a PBF file, in file order"""
+
+    with open(pbf_file, 'rb') as f:
+        blobs = _blob_index(f)
+        for blob_type, offset, size in blobs:
+            if blob_type == b'OSMHeader':
+                f.seek(offset)
+                _check_header(_blob_data(f.read(size)))
+        data_blobs = [(offset, size) for blob_type, offset, size in blobs if blob_type == b'OSMData']
+
+        if workers <= 1 or len(data_blobs) <= 1:
+            for offset, size in data_blobs:
+                f.seek(offset)
+                for record in _decode_block(f.read(size), tags):
+                    yield record
+            return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # Keep a couple of blocks per worker in flight, so memory does not grow with the file
+        pending = collections.deque()
+        for offset, size in data_blobs:
+            pending.append(pool.apply_async(_decode_block_at, ((pbf_file, offset, size, tags),)))
+            if len(pending) >= 2 * workers:
+                for record in pending.popleft().get():
+                    yield record
+        while pending:
+            for record in pending.popleft().get():
+                yield record
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _element(record):
+    """Build the OsmElement of a record, children in the order of the XML"""
+
+    OsmElement = osm_reader.OsmElement
+    tag, attrib, tags, refs, members = record
+    element = OsmElement(tag, attrib)
+    children = element.children
+    for ref in refs:
+        children.append(OsmElement('nd', {'ref': str(ref)}))
+    for member_type, ref, role in members:
+        children.append(OsmElement('member', {'type': member_type, 'ref': str(ref), 'role': role}))
+    for k, v in tags:
+        children.append(OsmElement('tag', {'k': k, 'v': v}))
+    return element
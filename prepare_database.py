@@ -1,19 +1,30 @@
 import csv
 import codecs
+import cStringIO
+import itertools
+import json
+import multiprocessing
+import os
 import pprint
 import re
-import xml.etree.cElementTree as ET
+import shutil
+import time
 import schema
+import osm_reader
+import profiling
 import cerberus
+from fast_validate import FastValidator
 from audit_street_name import update_street_name
-from audit_postal_code import update_post_code
-from audit_house_number import update_house_number
+from audit_postal_code import update_post_code, update_post_codes
+from audit_house_number import update_house_number, update_house_numbers
 from audit_amenities import update_amenity
+from normalizer_cache import BoundedCache
 from collections import defaultdict
+from operator import itemgetter
 
 # Script taken from UDacity tutorial, function shape_element has been modified to update names for: Street, postal code,
 # house numbers and amenities
-OSM_PATH = "bristol_map.osm"
+OSM_PATH = "bristol_map.osm"  # Also reads bristol_map.osm.bz2, .gz, .xz or .osm.pbf
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 
 
@@ -55,89 +66,172 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 SCHEMA = schema.schema
 
+# Validation modes, see validate_elements
+VALIDATE_SAMPLE_EVERY = 100
+VALIDATE_BATCH_SIZE = 1000
+# Tags cleaned a column at a time in the 'batch' clean mode, see shape_elements
+CLEAN_BATCH_SIZE = 1000
+
 # Make sure the fields order in the csvs matches the column order in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
 NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_MEMBERS_FIELDS = ['id', 'member_id', 'member_type', 'role', 'position']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+
+CSV_PATHS = [NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH,
+             RELATIONS_PATH, RELATION_MEMBERS_PATH, RELATION_TAGS_PATH]
+CSV_FIELDS = [NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS,
+              RELATION_FIELDS, RELATION_MEMBERS_FIELDS, RELATION_TAGS_FIELDS]
+# Shaped element field written to each csv, in CSV_PATHS order
+CSV_RECORDS = ['node', 'node_tags', 'way', 'way_nodes', 'way_tags',
+               'relation', 'relation_members', 'relation_tags']
+
+# Top-level elements read from the OSM file
+ELEMENT_TAGS = ('node', 'way', 'relation')
+
+# Start tag of a top-level element, used to align the chunks of a parallel run
+TOP_LEVEL_START = re.compile(br'<(?:node|way|relation)[\s/>]')
+# Chunks per worker process, more chunks than workers balance uneven chunks
+CHUNKS_PER_WORKER = 4
+# Largest chunk of a parallel run, large files are cut in more chunks than the above
+MAX_CHUNK_BYTES = 64 * 1024 * 1024
+# Input bytes between two checkpoints of a resumable run, see process_map
+CHECKPOINT_BYTES = 32 * 1024 * 1024
+
+# Bytes of csv text RowWriter buffers before writing them to the file
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+# Maximum number of distinct values remembered by each tag value cleaner
+NORMALIZER_CACHE_SIZE = 100000
+
+# Cleaners applied to tag values, keyed by the raw tag key ("k" attribute). Each one is
+# memoized: clear its cache (see clear_normalizer_caches) after changing a mapping.
+TAG_CLEANERS = {
+    "amenity": BoundedCache(lambda v: update_amenity(v, amenity_mapping), NORMALIZER_CACHE_SIZE),
+    "addr:street": BoundedCache(lambda v: update_street_name(v, street_mapping), NORMALIZER_CACHE_SIZE),
+    "addr:postcode": BoundedCache(lambda v: update_post_code(v, pc_mapping), NORMALIZER_CACHE_SIZE),
+    "addr:housenumber": BoundedCache(update_house_number, NORMALIZER_CACHE_SIZE),
+}
+
+# Column at a time versions of some of the cleaners, used by the 'batch' clean mode
+# (see shape_elements) on the values missing from the TAG_CLEANERS cache of the key.
+# Each one takes a list of raw values and returns the list of cleaned values.
+BATCH_CLEANERS = {
+    "addr:postcode": lambda values: update_post_codes(values, pc_mapping, validate=False)[0],
+    "addr:housenumber": lambda values: update_house_numbers(values, validate=False)[0],
+}
+
+# Dispatch tables, one per problem_chars pattern: raw tag key -> (type, key, cleaner),
+# or None when the key has problem characters. Filled in as new keys are seen, the
+# number of distinct keys in an extract is small compared to the number of tags.
+_tag_key_tables = {}
+
+
+def split_tag_key(k, problem_chars=PROBLEMCHARS):
+    """Return the memoized (type, key, cleaner) of a raw tag key, None to drop the tag"""
+    table = _tag_key_tables.setdefault(problem_chars, {})
+    try:
+        return table[k]
+    except KeyError:
+        pass
+
+    if problem_chars.search(k):
+        entry = None
+    elif LOWER_COLON.search(k):
+        tag_type, key = k.split(':', 1)
+        entry = (tag_type, key, TAG_CLEANERS.get(k))
+    else:
+        entry = ('regular', k, TAG_CLEANERS.get(k))
+    table[k] = entry
+    return entry
+
+
+def normalizer_cache_info():
+    """Return the hit/miss counters of each tag value cleaner cache"""
+    return dict((k, cleaner.info()) for k, cleaner in TAG_CLEANERS.items())
+
+
+def clear_normalizer_caches():
+    """Forget the cached results of the tag value cleaners"""
+    for cleaner in TAG_CLEANERS.values():
+        cleaner.clear()
+
+
+def shape_tags(element, problem_chars=PROBLEMCHARS, deferred=None):
+    """Clean and shape the <tag> children of a node, way or relation XML element
+
+    With a deferred dict, the tags whose key has a batch cleaner keep their raw value
+    and are appended to deferred[key] instead, to be cleaned later by clean_batch.
+    """
+    tags = []
+    element_id = element.attrib['id']
+    for tag in element.iter("tag"):
+        k = tag.attrib['k']
+        entry = split_tag_key(k, problem_chars)
+        if entry is not None:
+            tag_type, key, cleaner = entry
+            value = tag.attrib['v']
+            if deferred is not None and k in BATCH_CLEANERS:
+                shaped = {'id': element_id, 'key': key, 'value': value, 'type': tag_type}
+                deferred[k].append(shaped)
+                tags.append(shaped)
+                continue
+            tags.append({'id': element_id,
+                         'key': key,
+                         'value': cleaner(value) if cleaner else value,
+                         'type': tag_type})
+    return tags
+
+
+def clean_batch(deferred):
+    """Clean the values deferred by shape_tags, one call of the batch cleaner per key
+
+    The values go through the TAG_CLEANERS cache of their key, the batch cleaner only
+    sees the ones missing from it and the cache counts the hits and misses.
+    """
+    for k, tags in deferred.iteritems():
+        if not tags:
+            continue
+        values = TAG_CLEANERS[k].map([tag['value'] for tag in tags], BATCH_CLEANERS[k])
+        for tag, value in itertools.izip(tags, values):
+            tag['value'] = value
+        del tags[:]
 
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS):
-    """Clean and shape node or way XML element to Python dict"""
+                  problem_chars=PROBLEMCHARS, relation_attr_fields=RELATION_FIELDS, deferred=None):
+    """Clean and shape node, way or relation XML element to Python dict, see shape_tags for deferred"""
     node_attribs = {}
     way_attribs = {}
     way_nodes = []
-    tags = []
 
     if element.tag == 'node':
         # 1st level
         for i in node_attr_fields:
             node_attribs[i] = element.attrib[i]
         # 2nd level
-        for tag in element.iter("tag"):
-            problem = problem_chars.search(tag.attrib['k'])
-            if not problem:
-                node_tag = {}
-                node_tag['id'] = element.attrib['id']
-                node_tag['value'] = update_amenity(tag.attrib['v'], amenity_mapping) if tag.attrib['k'] == "amenity" else tag.attrib['v']
-
-                match = LOWER_COLON.search(tag.attrib['k'])
-                if not match:
-                    node_tag['type'] = 'regular'
-                    node_tag['key'] = tag.attrib['k']
-                else:
-                    bef_colon = re.findall('^(.+):', tag.attrib['k'])
-                    aft_colon = re.findall('^[a-z|_]+:(.+)', tag.attrib['k'])
-                    node_tag['type'] = bef_colon[0]
-                    node_tag['key'] = aft_colon[0]
-                    if node_tag['type'] == "addr" and node_tag['key'] == "street":
-                        # update street name
-                        node_tag['value'] = update_street_name(tag.attrib['v'], street_mapping)
-                    elif node_tag['type'] == "addr" and node_tag['key'] == "postcode":
-                        # update post code
-                        node_tag['value'] = update_post_code(tag.attrib['v'], pc_mapping)
-                    elif node_tag['type'] == "addr" and node_tag['key'] == "housenumber":
-                        # update house number
-                        node_tag['value'] = update_house_number(tag.attrib['v'])
-            tags.append(node_tag)
+        tags = shape_tags(element, problem_chars, deferred)
 
         return {'node': node_attribs, 'node_tags': tags}
 
     elif element.tag == 'way':
         for i in way_attr_fields:
             way_attribs[i] = element.attrib[i]
-        for tag in element.iter("tag"):
-            problem = PROBLEMCHARS.search(tag.attrib['k'])
-            if not problem:
-                way_tag = {}
-                way_tag['id'] = element.attrib['id']
-                way_tag['value'] = update_amenity(tag.attrib['v'], amenity_mapping) if tag.attrib['k'] == "amenity" else tag.attrib['v']
-                match = LOWER_COLON.search(tag.attrib['k'])
-                if not match:
-                    way_tag['type'] = 'regular'
-                    way_tag['key'] = tag.attrib['k']
-                else:
-                    bef_colon = re.findall('^(.+?):+[a-z]', tag.attrib['k'])
-                    aft_colon = re.findall('^[a-z|_]+:(.+)', tag.attrib['k'])
-
-                    way_tag['type'] = bef_colon[0]
-                    way_tag['key'] = aft_colon[0]
-                    if way_tag['type'] == "addr" and way_tag['key'] == "street":
-                        way_tag['value'] = update_street_name(tag.attrib['v'], street_mapping)
-                    elif way_tag['type'] == "addr" and way_tag['key'] == "postcode":
-                        way_tag['value'] = update_post_code(tag.attrib['v'], pc_mapping)
-                    elif way_tag['type'] == "addr" and way_tag['key'] == "housenumber":
-                        # update house number
-                        way_tag['value'] = update_house_number(tag.attrib['v'])
-            tags.append(way_tag)
+        tags = shape_tags(element, problem_chars, deferred)
         position = 0
         for tag in element.iter("nd"):
             nd = {}
@@ -150,19 +244,32 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
 
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
 
+    elif element.tag == 'relation':
+        relation_attribs = {}
+        for i in relation_attr_fields:
+            relation_attribs[i] = element.attrib[i]
+        tags = shape_tags(element, problem_chars, deferred)
+        element_id = element.attrib['id']
+        members = []
+        position = 0
+        for member in element.iter("member"):
+            members.append({'id': element_id,
+                            'member_id': member.attrib['ref'],
+                            'member_type': member.attrib['type'],
+                            'role': member.attrib.get('role', ''),
+                            'position': position})
+            position += 1
+
+        return {'relation': relation_attribs, 'relation_members': members, 'relation_tags': tags}
+
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=osm_reader.DEFAULT_BACKEND):
+    """Yield element if it is the right type of tag, parsed with the given osm_reader backend"""
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    return osm_reader.get_element(osm_file, tags, backend)
 
 
 def validate_element(element, validator, schema=SCHEMA):
@@ -175,6 +282,79 @@ def validate_element(element, validator, schema=SCHEMA):
         raise Exception(message_string.format(field, error_string))
 
 
+def shape_elements(elements, clean='element'):
+    """Yield the shaped dict of each XML element, skipping the ones shape_element ignores
+
+    clean is one of:
+        'element' - each tag value is cleaned on its own, by TAG_CLEANERS
+        'batch'   - elements are shaped CLEAN_BATCH_SIZE at a time and the values of
+                    the keys in BATCH_CLEANERS cleaned a column per batch, by clean_batch
+    """
+    if clean == 'element':
+        for element in elements:
+            el = shape_element(element)
+            if el:
+                yield el
+        return
+    elif clean != 'batch':
+        raise ValueError("Unknown clean mode {0!r}".format(clean))
+
+    deferred = defaultdict(list)
+    batch = []
+    for element in elements:
+        el = shape_element(element, deferred=deferred)
+        if el:
+            batch.append(el)
+            if len(batch) >= CLEAN_BATCH_SIZE:
+                clean_batch(deferred)
+                for shaped in batch:
+                    yield shaped
+                batch = []
+    clean_batch(deferred)
+    for shaped in batch:
+        yield shaped
+
+
+def validate_elements(shaped, validate):
+    """Yield the shaped elements once validated, raise an Exception on the first invalid one
+
+    validate is one of:
+        False     - no validation
+        True      - Cerberus, element by element (~10X slower)
+        'fast'    - schema compiled to plain checks by fast_validate, every element
+        'sampled' - fast checks on one element out of VALIDATE_SAMPLE_EVERY
+        'batch'   - fast checks run column by column on batches of VALIDATE_BATCH_SIZE
+    """
+    if not validate:
+        for el in shaped:
+            yield el
+    elif validate is True:
+        validator = cerberus.Validator()
+        for el in shaped:
+            validate_element(el, validator)
+            yield el
+    elif validate in ('fast', 'sampled'):
+        validator = FastValidator(SCHEMA, every=VALIDATE_SAMPLE_EVERY if validate == 'sampled' else 1)
+        for el in shaped:
+            validator.validate(el)
+            yield el
+    elif validate == 'batch':
+        validator = FastValidator(SCHEMA)
+        batch = []
+        for el in shaped:
+            batch.append(el)
+            if len(batch) >= VALIDATE_BATCH_SIZE:
+                validator.validate_batch(batch)
+                for validated in batch:
+                    yield validated
+                batch = []
+        validator.validate_batch(batch)
+        for validated in batch:
+            yield validated
+    else:
+        raise ValueError("Unknown validate mode {0!r}".format(validate))
+
+
 class UnicodeDictWriter(csv.DictWriter, object):
     """Extend csv.DictWriter to handle Unicode input"""
 
@@ -188,48 +368,415 @@ class UnicodeDictWriter(csv.DictWriter, object):
             self.writerow(row)
 
 
+class RowWriter(object):
+    """Buffered csv writer for rows given as tuples in field order
+
+    Unicode values are encoded to utf-8 once, rows are formatted by csv.writer into
+    an in-memory buffer and the buffer is written to the file in blocks of
+    buffer_size bytes. The output is the same as UnicodeDictWriter's. Call flush()
+    (or close the writer) before closing the file.
+    """
+
+    def __init__(self, f, fields, buffer_size=WRITE_BUFFER_SIZE):
+        self.file = f
+        self.fields = fields
+        self.buffer_size = buffer_size
+        self.buffer = cStringIO.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.rows = 0
+
+    def writeheader(self):
+        self.writer.writerow(self.fields)
+
+    def writerow(self, row):
+        self.writer.writerow([v.encode('utf-8') if v.__class__ is unicode else v for v in row])
+        self.rows += 1
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def writerows(self, rows):
+        rows = [[v.encode('utf-8') if v.__class__ is unicode else v for v in row] for row in rows]
+        self.writer.writerows(rows)
+        self.rows += len(rows)
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def close(self):
+        self.flush()
+
+
 # ================================================== #
-#               Main Function                        #
+#               Parallel Helper Functions            #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-            codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-            codecs.open(WAYS_PATH, 'w') as ways_file, \
-            codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-            codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
+def find_chunk_ranges(file_in, n_chunks):
+    """Split the OSM file into byte ranges starting on top-level element boundaries"""
+
+    if not osm_reader.is_plain_xml(file_in):
+        raise ValueError("Byte ranges need an uncompressed XML file, not {0}".format(file_in))
+    size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as osm_file:
+        first = _next_element_offset(osm_file, 0, size)
+        osm_file.seek(max(0, size - 1024))
+        tail = osm_file.read()
+        end = size - len(tail) + tail.rfind(b'</osm>') if b'</osm>' in tail else size
+
+        bounds = [first]
+        for i in range(1, n_chunks):
+            offset = _next_element_offset(osm_file, max(first, size * i // n_chunks), end)
+            if offset > bounds[-1]:
+                bounds.append(offset)
+    bounds.append(end)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+
+def _next_element_offset(osm_file, offset, end, block_size=65536):
+    """Return the offset of the first node, way or relation start tag at or after offset"""
+
+    # Keep a few bytes of overlap so a start tag split between two blocks is still found
+    overlap = 16
+    while offset < end:
+        osm_file.seek(offset)
+        block = osm_file.read(block_size)
+        match = TOP_LEVEL_START.search(block)
+        if match:
+            return min(offset + match.start(), end)
+        if len(block) < block_size:
+            break
+        offset += block_size - overlap
+    return end
+
+
+class ChunkFile(object):
+    """Byte range of the OSM file read as a file object, wrapped in <osm></osm>
+
+    The range is read as the parser asks for it, it is never held in memory whole.
+    """
+
+    def __init__(self, file_in, start, end):
+        self.file = open(file_in, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+        self.head = b'<osm>'
+        self.tail = b'</osm>'
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.remaining + len(self.head) + len(self.tail)
+        data = self.head[:size]
+        self.head = self.head[len(data):]
+        if len(data) < size and self.remaining:
+            block = self.file.read(min(size - len(data), self.remaining))
+            self.remaining -= len(block)
+            if not block:
+                self.remaining = 0
+            data += block
+        if len(data) < size and not self.remaining:
+            end = self.tail[:size - len(data)]
+            self.tail = self.tail[len(end):]
+            data += end
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _output_paths(node_store=None):
+    """Paths of the csv(s), followed by the files of the node store when there is one"""
+
+    if not node_store:
+        return CSV_PATHS
+    # Imported only when a store is built, see node_store
+    from node_store import node_store_files
+    return CSV_PATHS + node_store_files(node_store)
+
+
+def _finalize_node_store(node_store=None):
+    """Finalize the node store of a run, when it builds one"""
+
+    if node_store:
+        from node_store import finalize_node_store
+        finalize_node_store(node_store)
+
+
+def _process_chunk(args):
+    """Worker: shape the elements of one byte range and write them to csv (and node store) shards"""
+
+    file_in, start, end, validate, backend, chunk_id, node_store, clean = args
+    chunk_file = ChunkFile(file_in, start, end)
+    shard_paths = ['{0}.part{1:05d}'.format(path, chunk_id) for path in CSV_PATHS]
+    store_shard = '{0}.part{1:05d}'.format(node_store, chunk_id) if node_store else None
+    elements = get_element(chunk_file, tags=ELEMENT_TAGS, backend=backend)
+    last = []
+    # In a profiled run the chunk gets its own profiler, its figures are handed back
+    # to the run (workers are forked, they cannot update the profiler of the parent)
+    run_profiler = profiling.current()
+    profiler = profiling.enable('chunk') if run_profiler else None
+    try:
+        write_elements(_remember_last(elements, last), shard_paths, validate, header=False,
+                       node_store=store_shard, clean=clean)
+    finally:
+        chunk_file.close()
+        profiling.activate(run_profiler)
+    store_files = _output_paths(store_shard)[len(CSV_PATHS):]
+    return shard_paths + store_files, last[0] if last else None, profiler.snapshot() if profiler else None
+
+
+def _merge_profile(profile):
+    """Add the figures of a worker to the profiler of the run, if any"""
+
+    profiler = profiling.current()
+    if profiler is not None and profile is not None:
+        profiler.merge(profile)
+
+
+def _remember_last(elements, last):
+    """Yield the elements, keeping 'type/id' of the latest one in last[0]"""
+    for elem in elements:
+        last[:] = ['{0}/{1}'.format(elem.tag, elem.attrib['id'])]
+        yield elem
+
+
+def _merge_shards(chunk_shards, output_paths=CSV_PATHS):
+    """Concatenate per-chunk shards in chunk order, the csv(s) behind a single header"""
+
+    for i, path in enumerate(output_paths):
+        with codecs.open(path, 'w') as out_file:
+            if i < len(CSV_FIELDS):
+                csv.writer(out_file).writerow(CSV_FIELDS[i])
+            for shards in chunk_shards:
+                with open(shards[i], 'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, out_file)
+                os.remove(shards[i])
+
+
+def _input_fingerprint(file_in):
+    stat = os.stat(file_in)
+    return {'input': os.path.abspath(file_in), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _load_checkpoint(checkpoint, file_in, output_paths):
+    """Return the saved state of an interrupted run over file_in, None to start afresh"""
+
+    if not os.path.exists(checkpoint):
+        return None
+    with open(checkpoint, 'rb') as f:
+        state = json.loads(f.read().decode('utf-8'))
+    fingerprint = _input_fingerprint(file_in)
+    if any(state.get(k) != v for k, v in fingerprint.items()):
+        print('{0} is for another version of the input, starting over'.format(checkpoint))
+        return None
+    if set(state['positions']) != set(output_paths):
+        print('{0} was written for other outputs, starting over'.format(checkpoint))
+        return None
+    for path, position in state['positions'].items():
+        if not os.path.exists(path) or os.path.getsize(path) < position:
+            print('{0} is shorter than at the checkpoint, starting over'.format(path))
+            return None
+    return state
+
+
+def _save_checkpoint(checkpoint, state):
+    """Write the checkpoint next to its final name, then rename it over the previous one"""
+
+    tmp_path = checkpoint + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps(state, indent=1).encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+    if os.name == 'nt' and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    os.rename(tmp_path, checkpoint)
+
+
+def _resumable_process_map(file_in, validate, workers, backend, checkpoint, node_store=None, clean='element'):
+    """process_map in chunks of CHECKPOINT_BYTES, appended to the csv(s) in file order
+
+    After each chunk the csv(s) are synced and the checkpoint records the input
+    offset reached, the last element written and the size of each csv. A new run
+    with the same checkpoint truncates the csv(s) back to those sizes, dropping the
+    rows of the chunk that was interrupted, and carries on from that offset.
+    """
+
+    output_paths = _output_paths(node_store)
+    state = _load_checkpoint(checkpoint, file_in, output_paths)
+    if state is None:
+        n_chunks = max(1, os.path.getsize(file_in) // CHECKPOINT_BYTES)
+        state = _input_fingerprint(file_in)
+        state.update({'chunks': n_chunks, 'offset': 0, 'last_element': None})
+        for i, path in enumerate(output_paths):
+            with open(path, 'wb') as out_file:
+                if i < len(CSV_FIELDS):
+                    csv.writer(out_file).writerow(CSV_FIELDS[i])
+        state['positions'] = dict((path, os.path.getsize(path)) for path in output_paths)
+        _save_checkpoint(checkpoint, state)
+    else:
+        print('Resuming {0} at byte {1}, after {2}'.format(file_in, state['offset'], state['last_element']))
+        for path, position in state['positions'].items():
+            with open(path, 'r+b') as out_file:
+                out_file.truncate(position)
+
+    # The chunk boundaries only depend on the input and the number of chunks, so they
+    # are the same as in the interrupted run
+    ranges = [(start, end) for start, end in find_chunk_ranges(file_in, state['chunks'])
+              if start >= state['offset']]
+    args = [(file_in, start, end, validate, backend, i, node_store, clean) for i, (start, end) in enumerate(ranges)]
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        # imap returns the chunks in file order, as soon as each one is done
+        results = pool.imap(_process_chunk, args) if pool else itertools.imap(_process_chunk, args)
+        for (start, end), (shard_paths, last_element, profile) in itertools.izip(ranges, results):
+            _merge_profile(profile)
+            for path, shard_path in zip(output_paths, shard_paths):
+                with open(path, 'ab') as out_file, open(shard_path, 'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, out_file)
+                    out_file.flush()
+                    os.fsync(out_file.fileno())
+                    state['positions'][path] = out_file.tell()
+                os.remove(shard_path)
+            state['offset'] = end
+            state['last_element'] = last_element or state['last_element']
+            _save_checkpoint(checkpoint, state)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    _finalize_node_store(node_store)
+    os.remove(checkpoint)
 
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
 
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def write_elements(elements, csv_paths, validate, header=True, node_store=None, clean='element'):
+    """Shape each XML element and write it to the csv(s) in csv_paths, see
+    validate_elements for validate and shape_elements for clean
+
+    With a node_store path, the id and coordinates of each node are also written to
+    a node_store.NodeStoreWriter there. The store still needs finalize_node_store.
+    """
+
+    files = [codecs.open(path, 'w') for path in csv_paths]
+    node_writer = None
+    if node_store:
+        from node_store import NodeStoreWriter
+        node_writer = NodeStoreWriter(node_store)
+    profiler = profiling.current()
+    try:
+        writers = [RowWriter(f, fields) for f, fields in zip(files, CSV_FIELDS)]
+        # Shaped records are dicts, itemgetter turns them into tuples in csv field order
+        record_writers = dict((record, (writer, itemgetter(*fields)))
+                              for record, writer, fields in zip(CSV_RECORDS, writers, CSV_FIELDS))
+
+        if header:
+            for writer in writers:
+                writer.writeheader()
+
+        if profiler is None:
+            shaped = validate_elements(shape_elements(elements, clean), validate)
+        else:
+            # Each stage is timed with the stages feeding it, the report subtracts them
+            cleaners_before = normalizer_cache_info()
+            shaped = profiler.timed('shape', shape_elements(profiler.timed('parse', elements), clean), inner='parse')
+            shaped = profiler.timed('validate', validate_elements(shaped, validate), inner='shape')
+            write_start = time.time()
+
+        # Each shaped element holds one record for its own table and lists of child
+        # records (tags, way nodes, relation members) for the others
+        for el in shaped:
+            for record, value in el.iteritems():
+                writer, to_row = record_writers[record]
+                if isinstance(value, list):
+                    writer.writerows(map(to_row, value))
+                else:
+                    writer.writerow(to_row(value))
+            if node_writer is not None and 'node' in el:
+                node = el['node']
+                node_writer.add(node['id'], node['lat'], node['lon'])
+
+        for writer in writers:
+            writer.close()
+
+        if profiler is not None:
+            profiler.add_time('write', time.time() - write_start, inner='validate')
+            for record, writer in zip(CSV_RECORDS, writers):
+                profiler.count('rows:' + record, writer.rows)
+                if record in ('node', 'way', 'relation'):
+                    profiler.count('elements', writer.rows)
+                elif record.endswith('_tags'):
+                    profiler.count('tags', writer.rows)
+            cleaners_after = normalizer_cache_info()
+            profiler.add_cleaners(dict((k, dict((field, info[field] - cleaners_before[k][field])
+                                                for field in ('hits', 'misses', 'seconds')))
+                                       for k, info in cleaners_after.items()))
+    finally:
+        for f in files:
+            f.close()
+        if node_writer is not None:
+            node_writer.close()
+
+
+def process_map(file_in, validate, workers=1, backend=osm_reader.DEFAULT_BACKEND, checkpoint=None,
+                node_store=None, clean='element'):
+    """Iteratively process each XML element and write to csv(s)
+
+    With workers > 1 the file is split into byte ranges aligned on element
+    boundaries, each range is shaped in its own process and the csv shards are
+    concatenated in file order. OSM files are sorted by type then id, so the
+    merged csv(s) keep the id order of the serial run. backend selects the XML
+    parser, see osm_reader.
+
+    With a checkpoint path the run can be resumed: progress is saved there every
+    CHECKPOINT_BYTES of input, and running process_map again with the same
+    checkpoint after a crash continues from the last one instead of starting over.
+    The checkpoint is removed once the run completes.
+
+    With a node_store path, a node id -> coordinates store is built there along the
+    way, see node_store.NodeStore and way_geometry.
+
+    clean selects how tag values are cleaned, element by element or a column per
+    batch of elements, see shape_elements. Both write the same csv(s).
+
+    Compressed files (.bz2, .gz, .xz) are read without decompressing them to disk,
+    see decompress, and PBF files (.osm.pbf) with pbf_reader. Neither can be split
+    into byte ranges: the elements are shaped in one process, workers then sets the
+    processes decompressing a multi-stream bz2 file or decoding the PBF blocks, and
+    a checkpoint needs an uncompressed XML file.
+    """
+
+    if checkpoint:
+        if not osm_reader.is_plain_xml(file_in):
+            raise ValueError("Checkpoints record byte offsets, they need an uncompressed XML file, not {0}".format(
+                file_in))
+        _resumable_process_map(file_in, validate, workers, backend, checkpoint, node_store, clean)
+        return
+
+    if workers <= 1 or not osm_reader.is_plain_xml(file_in):
+        elements = osm_reader.get_element(file_in, ELEMENT_TAGS, backend, workers if workers > 1 else None)
+        write_elements(elements, CSV_PATHS, validate, node_store=node_store, clean=clean)
+        _finalize_node_store(node_store)
+        return
+
+    ranges = find_chunk_ranges(file_in, max(workers * CHUNKS_PER_WORKER,
+                                            os.path.getsize(file_in) // MAX_CHUNK_BYTES + 1))
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_process_chunk, [(file_in, start, end, validate, backend, i, node_store, clean)
+                                            for i, (start, end) in enumerate(ranges)])
+    finally:
+        pool.close()
+        pool.join()
+    for _, _, profile in results:
+        _merge_profile(profile)
+    _merge_shards([shard_paths for shard_paths, _, _ in results], _output_paths(node_store))
+    _finalize_node_store(node_store)
 
 
 if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
-    process_map(OSM_PATH, validate=False)
+    # Note: Cerberus validation (validate=True) is ~ 10X slower. The compiled checks
+    # of fast_validate cost little enough to stay on for full loads.
+    process_map(OSM_PATH, validate='batch', clean='batch')
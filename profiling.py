@@ -0,0 +1,180 @@
+import cProfile
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Opt-in instrumentation for the pipeline. Nothing is measured unless a profiler is
+# enabled, usually with profile_run:
+#
+#     with profiling.profile_run('profile.json', cprofile_path='profile.prof'):
+#         prepare_database.process_map(OSM_PATH, validate='batch', clean='batch')
+#
+# The instrumented code asks current() for the active profiler and records:
+#   stages   - seconds per stage (parse, shape, validate, write, sql_insert:<table>),
+#              exclusive of the stages nested in them
+#   counters - rows per output file / table, elements and tags
+#   cleaners - hits, misses and seconds spent normalizing for each tag value cleaner
+# The report adds the wall time, elements and tags per second and the peak RSS.
+
+_current = None
+
+
+# Function returning the active profiler, None when profiling is off
+def current():
+    return _current
+
+
+class StageProfiler(object):
+    """Per-stage timers and counters of one run"""
+
+    def __init__(self, name='run'):
+        self.name = name
+        self.start = time.time()
+        # stage -> [inclusive seconds, calls, inner stage or None]
+        self.timers = {}
+        self.counters = {}
+        self.cleaners = {}
+
+    def add_time(self, stage, seconds, calls=1, inner=None):
+        timer = self.timers.setdefault(stage, [0.0, 0, inner])
+        timer[0] += seconds
+        timer[1] += calls
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_cleaners(self, cleaners):
+        for k, info in cleaners.items():
+            totals = self.cleaners.setdefault(k, {'hits': 0, 'misses': 0, 'seconds': 0.0})
+            for field in totals:
+                totals[field] += info[field]
+
+    def timed(self, stage, iterable, inner=None):
+        """Yield the items of iterable, timing how long each one takes to produce
+
+        The time includes the stages feeding iterable: name the one directly below
+        as inner, and the report subtracts it.
+        """
+        iterator = iter(iterable)
+        clock = time.time
+        seconds = 0.0
+        calls = 0
+        try:
+            while True:
+                t = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    seconds += clock() - t
+                    break
+                seconds += clock() - t
+                calls += 1
+                yield item
+        finally:
+            self.add_time(stage, seconds, calls, inner)
+
+    @contextmanager
+    def stage(self, stage, inner=None):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - t, 1, inner)
+
+    def snapshot(self):
+        """Return the raw timers and counters, to merge them into another profiler"""
+        return {'timers': self.timers, 'counters': self.counters, 'cleaners': self.cleaners}
+
+    def merge(self, snapshot):
+        for stage, (seconds, calls, inner) in snapshot['timers'].items():
+            self.add_time(stage, seconds, calls, inner)
+        for name, n in snapshot['counters'].items():
+            self.count(name, n)
+        self.add_cleaners(snapshot['cleaners'])
+
+    def report(self):
+        wall = time.time() - self.start
+        stages = {}
+        for stage, (seconds, calls, inner) in self.timers.items():
+            exclusive = seconds - (self.timers[inner][0] if inner in self.timers else 0.0)
+            stages[stage] = {'seconds': round(exclusive, 6), 'inclusive_seconds': round(seconds, 6),
+                             'calls': calls}
+        elements = self.counters.get('elements', 0)
+        tags = self.counters.get('tags', 0)
+        return {
+            'name': self.name,
+            'wall_seconds': round(wall, 6),
+            'stages': stages,
+            'counters': self.counters,
+            'rates': {'elements_per_sec': round(elements / wall, 1) if wall else 0.0,
+                      'tags_per_sec': round(tags / wall, 1) if wall else 0.0},
+            'cleaners': self.cleaners,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    def write_report(self, path):
+        report = self.report()
+        with open(path, 'wb') as f:
+            f.write(json.dumps(report, indent=2, sort_keys=True).encode('utf-8'))
+        return report
+
+
+# Function returning the peak RSS in MB of this process and of its finished children
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    return {'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit, 1),
+            'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit, 1)}
+
+
+# Function to make profiler the active one, None turns profiling off
+def activate(profiler):
+    global _current
+    _current = profiler
+
+
+# Function to turn profiling on, returns the new profiler
+def enable(name='run'):
+    profiler = StageProfiler(name)
+    activate(profiler)
+    return profiler
+
+
+# Function to turn profiling off
+def disable():
+    activate(None)
+
+
+# Function to run func(*args), timed as a stage of the active profiler when profiling is on
+def timed_stage(stage, func, *args):
+    profiler = current()
+    if profiler is None:
+        return func(*args)
+    with profiler.stage(stage):
+        return func(*args)
+
+
+@contextmanager
+def profile_run(report_path=None, cprofile_path=None, name='run'):
+    """Profile the body of the with statement, then write the JSON report and cProfile dump"""
+    profiler = enable(name)
+    cprofiler = cProfile.Profile() if cprofile_path else None
+    if cprofiler:
+        cprofiler.enable()
+    try:
+        yield profiler
+    finally:
+        if cprofiler:
+            cprofiler.disable()
+            cprofiler.dump_stats(cprofile_path)
+        disable()
+        if report_path:
+            profiler.write_report(report_path)
@@ -1,32 +1,141 @@
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+import math
+import os
 
-OSM_FILE = "bristol_map.osm"  # Replace this with your osm file
+import osm_reader  # Set BACKEND to "lxml" if too slow
+from prepare_database import TOP_LEVEL_START, find_chunk_ranges
+
+OSM_FILE = "bristol_map.osm"  # Replace this with your osm file, which can be .bz2, .gz or .xz compressed, or .osm.pbf
 SAMPLE_FILE = "sample.osm"
 
 k = 20  # Parameter: take every k-th top level element
+BACKEND = osm_reader.DEFAULT_BACKEND  # Parameter: XML parser backend, see osm_reader
+
+# Parameter: sampling mode
+#   every_k    - every k-th top level element, references to elements left out are broken
+#   ways       - every k-th way with all of its nodes, two passes over the file
+#   bbox       - the nodes inside BBOX, the ways using them with all of their nodes, two passes
+#   byte_range - N_RANGES slices of raw XML spread over the file, no parsing at all
+MODE = "every_k"
+BBOX = (51.44, -2.62, 51.47, -2.56)  # Parameter: (min_lat, min_lon, max_lat, max_lon) of the bbox mode
+TARGET_SIZE = None  # Parameter: approximate sample size in bytes, sets k (or the slice size of byte_range)
+N_RANGES = 50  # Parameter: number of slices of the byte_range mode
 
+SAMPLE_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n  '.encode()
+SAMPLE_FOOTER = '</osm>'.encode()
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=BACKEND):
     """Yield element if it is the right type of tag
 
     Reference:
     http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    return osm_reader.get_element(osm_file, tags, backend)
+
+
+# Function returning the k that gives a sample of about target_size bytes
+def k_for_target_size(osm_file, target_size):
+    return max(1, int(math.ceil(os.path.getsize(osm_file) / float(target_size))))
+
+
+# Function to write the elements to a sample file
+def write_sample(elements, sample_file=SAMPLE_FILE):
+    with open(sample_file, 'wb') as output:
+        output.write(SAMPLE_HEADER)
+        for element in elements:
+            output.write(osm_reader.tostring(element))
+        output.write(SAMPLE_FOOTER)
+
+
+# Function yielding every kth top level element
+def sample_every_k(osm_file, k=k, backend=BACKEND):
+    for i, element in enumerate(get_element(osm_file, backend=backend)):
+        if i % k == 0:
+            yield element
 
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n'.encode())
-    output.write('<osm>\n  '.encode())
+# Function yielding the elements selected by pass 1 from a second pass over the file:
+# the nodes in node_ids, the ways in way_ids and the relations with at least one of
+# them as a member. Relation members outside the sample are dropped, so every
+# reference resolves.
+def _second_pass(osm_file, node_ids, way_ids, backend):
+    kept = {'node': node_ids, 'way': way_ids, 'relation': set()}
+    for element in get_element(osm_file, backend=backend):
+        element_id = int(element.attrib['id'])
+        if element.tag != 'relation':
+            if element_id in kept[element.tag]:
+                yield element
+            continue
+        members = list(element.iter('member'))
+        if not any(m.attrib['type'] != 'relation' and int(m.attrib['ref']) in kept.get(m.attrib['type'], ())
+                   for m in members):
+            continue
+        for member in members:
+            # Relations can only refer to the relations already kept above them
+            if int(member.attrib['ref']) not in kept.get(member.attrib['type'], ()):
+                element.remove(member)
+        kept['relation'].add(element_id)
+        yield element
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
+
+# Function yielding every kth way with all of its nodes, and the relations using them
+def sample_ways(osm_file, k=k, backend=BACKEND):
+    way_ids = set()
+    node_ids = set()
+    for i, element in enumerate(get_element(osm_file, tags=('way',), backend=backend)):
         if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
+            way_ids.add(int(element.attrib['id']))
+            node_ids.update(int(nd.attrib['ref']) for nd in element.iter('nd'))
+    return _second_pass(osm_file, node_ids, way_ids, backend)
+
+
+# Function yielding the nodes inside a bounding box, the ways using any of them with
+# all of their nodes (also the ones outside), and the relations using them
+def sample_bbox(osm_file, bbox=BBOX, backend=BACKEND):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    node_ids = set()
+    way_ids = set()
+    for element in get_element(osm_file, tags=('node', 'way'), backend=backend):
+        if element.tag == 'node':
+            if min_lat <= float(element.attrib['lat']) <= max_lat and \
+                    min_lon <= float(element.attrib['lon']) <= max_lon:
+                node_ids.add(int(element.attrib['id']))
+        else:
+            refs = [int(nd.attrib['ref']) for nd in element.iter('nd')]
+            if any(ref in node_ids for ref in refs):
+                way_ids.add(int(element.attrib['id']))
+                node_ids.update(refs)
+    return _second_pass(osm_file, node_ids, way_ids, backend)
+
+
+# Function to write n_ranges slices of raw XML, of target_size / n_ranges bytes each,
+# spread evenly over the file. Slices start and end on top level elements and are
+# copied without parsing, so references between elements may be broken.
+def write_byte_range_sample(osm_file, target_size, sample_file=SAMPLE_FILE, n_ranges=N_RANGES):
+    slice_size = max(1, target_size // n_ranges)
+    with open(osm_file, 'rb') as f, open(sample_file, 'wb') as output:
+        output.write(SAMPLE_HEADER)
+        for start, end in find_chunk_ranges(osm_file, n_ranges):
+            f.seek(start)
+            data = f.read(min(end - start, slice_size + 1))
+            if start + len(data) < end:
+                # Cut before the last element start, the element it opens is incomplete
+                starts = [match.start() for match in TOP_LEVEL_START.finditer(data)]
+                data = data[:starts[-1]] if len(starts) > 1 else b''
+            output.write(data)
+        output.write(SAMPLE_FOOTER)
+
 
-    output.write('</osm>'.encode())
+if __name__ == '__main__':
+    if TARGET_SIZE:
+        k = k_for_target_size(OSM_FILE, TARGET_SIZE)
+    if MODE == "every_k":
+        write_sample(sample_every_k(OSM_FILE, k))
+    elif MODE == "ways":
+        write_sample(sample_ways(OSM_FILE, k))
+    elif MODE == "bbox":
+        write_sample(sample_bbox(OSM_FILE, BBOX))
+    elif MODE == "byte_range":
+        write_byte_range_sample(OSM_FILE, TARGET_SIZE or os.path.getsize(OSM_FILE) // k)
+    else:
+        raise ValueError("Unknown sampling mode '{0}'".format(MODE))
@@ -0,0 +1,106 @@
+import math
+import sqlite3
+
+# Script to build SQLite R*Tree indexes over the node coordinates and the bounding
+# boxes of the ways, and to answer bounding box and radius queries with them instead
+# of scanning the node table. R*Tree coordinates are stored as 32-bit floats rounded
+# outwards, so the candidates are checked again against the exact lat/lon of the
+# node table.
+SQLITE_FILE = 'bristol.db'
+
+EARTH_RADIUS_M = 6371008.8
+
+SPATIAL_TABLES = [
+    'CREATE VIRTUAL TABLE IF NOT EXISTS node_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);',
+    'CREATE VIRTUAL TABLE IF NOT EXISTS way_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);',
+]
+
+NODE_BOXES = 'SELECT id, lat, lat, lon, lon FROM node'
+WAY_BOXES = 'SELECT w.id, MIN(n.lat), MAX(n.lat), MIN(n.lon), MAX(n.lon) ' \
+            'FROM way_nodes w JOIN node n ON n.id = w.node_id'
+
+
+# Function to (re)build the R*Tree indexes from the node and way_nodes tables
+def build_spatial_index(conn):
+    for table in SPATIAL_TABLES:
+        conn.execute(table)
+    conn.execute('DELETE FROM node_rtree;')
+    conn.execute('DELETE FROM way_rtree;')
+    conn.execute('INSERT INTO node_rtree ' + NODE_BOXES + ' WHERE lat IS NOT NULL;')
+    conn.execute('INSERT INTO way_rtree ' + WAY_BOXES + ' GROUP BY w.id;')
+    conn.commit()
+
+
+# Function returning True when the database has the R*Tree indexes
+def has_spatial_index(conn):
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'node_rtree';").fetchone()[0] > 0
+
+
+# Function to refresh the R*Tree entries of changed nodes and ways, without a rebuild.
+# The ways using a changed node get a new bounding box too. Does not commit.
+def update_spatial_index(conn, node_ids, way_ids):
+    node_ids = [(i,) for i in set(node_ids)]
+    way_ids = set(way_ids)
+    for (node_id,) in node_ids:
+        way_ids.update(row[0] for row in conn.execute('SELECT id FROM way_nodes WHERE node_id = ?;', (node_id,)))
+    way_ids = [(i,) for i in way_ids]
+
+    conn.executemany('DELETE FROM node_rtree WHERE id = ?;', node_ids)
+    conn.executemany('INSERT INTO node_rtree ' + NODE_BOXES + ' WHERE id = ? AND lat IS NOT NULL;', node_ids)
+    conn.executemany('DELETE FROM way_rtree WHERE id = ?;', way_ids)
+    conn.executemany('INSERT INTO way_rtree ' + WAY_BOXES + ' WHERE w.id = ? GROUP BY w.id;', way_ids)
+
+
+# Function returning (id, lat, lon) of the nodes inside a bounding box, optionally
+# only the ones with a given tag key (and value)
+def nodes_in_bbox(conn, min_lat, min_lon, max_lat, max_lon, key=None, value=None):
+    sql = 'SELECT n.id, n.lat, n.lon FROM node_rtree r JOIN node n ON n.id = r.id '
+    params = [max_lat, min_lat, max_lon, min_lon]
+    if key is not None:
+        sql += 'JOIN node_tags t ON t.id = n.id AND t.key = ? ' + ('AND t.value = ? ' if value is not None else '')
+        params[:0] = [key] + ([value] if value is not None else [])
+    sql += 'WHERE r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ? ' \
+           'AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?;'
+    params += [min_lat, max_lat, min_lon, max_lon]
+    return conn.execute(sql, params).fetchall()
+
+
+# Function returning the ids of the ways whose bounding box intersects a bounding box
+def ways_in_bbox(conn, min_lat, min_lon, max_lat, max_lon):
+    return [row[0] for row in conn.execute(
+        'SELECT id FROM way_rtree WHERE min_lat <= ? AND max_lat >= ? AND min_lon <= ? AND max_lon >= ?;',
+        (max_lat, min_lat, max_lon, min_lon))]
+
+
+# Function returning the great circle distance in metres between two points
+def distance_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+# Function returning the bounding box (min_lat, min_lon, max_lat, max_lon) of a circle
+def radius_bbox(lat, lon, radius_m):
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    cos_lat = math.cos(math.radians(lat))
+    dlon = 180.0 if cos_lat < 1e-9 else min(180.0, dlat / cos_lat)
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+# Function returning (distance in metres, id, lat, lon) of the nodes within radius_m
+# of a point, nearest first, optionally only the ones with a given tag key (and value)
+def nodes_within_radius(conn, lat, lon, radius_m, key=None, value=None):
+    min_lat, min_lon, max_lat, max_lon = radius_bbox(lat, lon, radius_m)
+    found = []
+    for node_id, node_lat, node_lon in nodes_in_bbox(conn, min_lat, min_lon, max_lat, max_lon, key, value):
+        distance = distance_m(lat, lon, node_lat, node_lon)
+        if distance <= radius_m:
+            found.append((distance, node_id, node_lat, node_lon))
+    found.sort()
+    return found
+
+
+if __name__ == '__main__':
+    conn = sqlite3.connect(SQLITE_FILE)
+    build_spatial_index(conn)
+    conn.close()
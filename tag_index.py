@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import xml.etree.cElementTree as ET
+import xml.parsers.expat
+from collections import defaultdict
+
+from cache_meta import AUDIT_KEYS, AUDIT_TYPES, is_current
+from osm_reader import is_plain_xml
+
+# The check_*_details functions in the audit scripts rescan the whole OSM file to
+# look up a single value. This script builds a one-time on-disk index from
+# (tag key, value) to the byte offset and length of every element carrying it,
+# so a lookup only has to seek to the matching elements and parse those.
+
+CHUNK_SIZE = 1024 * 1024
+BATCH_SIZE = 10000
+
+
+# Function returning the default index location, stored next to the OSM file
+def default_index_path(osmfile):
+    return osmfile + ".tagidx.db"
+
+
+class _Tag(object):
+    """Minimal stand-in for a <tag> element, enough for the audit is_* functions"""
+    __slots__ = ('attrib',)
+
+    def __init__(self, attrib):
+        self.attrib = attrib
+
+
+class _IndexBuilder(object):
+    """expat callbacks recording the byte span and tags of every top-level element"""
+
+    def __init__(self, parser, cur, keys, types, engine):
+        self.parser = parser
+        self.cur = cur
+        self.keys = None if keys is None else frozenset(keys)
+        self.types = frozenset(types)
+        self.engine = engine
+        self.depth = 0
+        self.element = None
+        self.tags = []
+        self.rows = []
+        # Data fed to the parser so far, kept to tell "</node>" from "<node .../>"
+        self.buf = b''
+        self.buf_start = 0
+
+    def start(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2 and name in self.types:
+            self.element = (name, attrs['id'], self.parser.CurrentByteIndex)
+            self.tags = []
+        elif self.depth == 3 and self.element is not None and name == 'tag':
+            if self.engine is not None:
+                self.engine.audit_tag(_Tag(attrs))
+            if self.keys is None or attrs['k'] in self.keys:
+                self.tags.append((attrs['k'], attrs['v']))
+
+    def end(self, name):
+        if self.depth == 2 and self.element is not None:
+            elem_type, elem_id, offset = self.element
+            end = self.parser.CurrentByteIndex
+            pos = end - self.buf_start
+            # For an explicit end tag the index points at "</", otherwise it is
+            # already past the "/>" of a self-closing element
+            if self.buf[pos:pos + 2] == b'</':
+                end += len(name) + 3
+            for k, v in self.tags:
+                self.rows.append((k, v, elem_type, int(elem_id), offset, end - offset))
+            if len(self.rows) >= BATCH_SIZE:
+                self.flush()
+            self.element = None
+        self.depth -= 1
+
+    def flush(self):
+        self.cur.executemany('INSERT INTO tag_index(key, value, type, id, offset, length) '
+                             'VALUES (?, ?, ?, ?, ?, ?);', self.rows)
+        self.rows = []
+
+
+# Function to build the (key, value) -> element index for an OSM file
+# When an AuditEngine is given, every <tag> is also handed to it, so the index is
+# built during the same pass as the audit
+def build_index(osmfile, index_path=None, keys=AUDIT_KEYS, types=AUDIT_TYPES, engine=None):
+    if not is_plain_xml(osmfile):
+        raise ValueError("The tag index stores byte offsets, it needs an uncompressed XML file, not {0}".format(
+            osmfile))
+    index_path = index_path or default_index_path(osmfile)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    conn = sqlite3.connect(index_path)
+    cur = conn.cursor()
+    cur.execute('''
+        CREATE TABLE tag_index (
+            key TEXT,
+            value TEXT,
+            type TEXT,
+            id INTEGER,
+            offset INTEGER,
+            length INTEGER
+            );
+            ''')
+    cur.execute('CREATE TABLE meta (size INTEGER, mtime REAL, keys TEXT, types TEXT);')
+
+    parser = xml.parsers.expat.ParserCreate()
+    builder = _IndexBuilder(parser, cur, keys, types, engine)
+    parser.StartElementHandler = builder.start
+    parser.EndElementHandler = builder.end
+
+    with open(osmfile, 'rb') as osm_file:
+        offset = 0
+        prev = b''
+        while True:
+            chunk = osm_file.read(CHUNK_SIZE)
+            builder.buf = prev + chunk
+            builder.buf_start = offset - len(prev)
+            parser.Parse(chunk, not chunk)
+            if not chunk:
+                break
+            offset += len(chunk)
+            prev = chunk
+    builder.flush()
+
+    cur.execute('CREATE INDEX tag_index_key_value ON tag_index (key, value);')
+    stat = os.stat(osmfile)
+    cur.execute('INSERT INTO meta(size, mtime, keys, types) VALUES (?, ?, ?, ?);',
+                (stat.st_size, stat.st_mtime, None if keys is None else '\n'.join(keys), '\n'.join(types)))
+    conn.commit()
+    conn.close()
+    return index_path
+
+
+# Function to get the (type, id, offset, length) of every element with one of the
+# given keys set to value, building the index first if needed
+def find_elements(osmfile, keys, value, index_path=None):
+    index_path = index_path or default_index_path(osmfile)
+    if not is_current(osmfile, index_path, keys, AUDIT_TYPES):
+        build_index(osmfile, index_path, keys=None if set(keys) - set(AUDIT_KEYS) else AUDIT_KEYS)
+    conn = sqlite3.connect(index_path)
+    query = 'SELECT DISTINCT type, id, offset, length FROM tag_index WHERE key IN ({0}) AND value = ? ' \
+            'ORDER BY offset;'.format(', '.join('?' * len(keys)))
+    elements = conn.execute(query, tuple(keys) + (value,)).fetchall()
+    conn.close()
+    return elements
+
+
+# Function to read and parse a single element given its byte span in the OSM file
+def read_element(osm_file, offset, length):
+    osm_file.seek(offset)
+    return ET.fromstring(osm_file.read(length))
+
+
+# Function which retrieves the tags of every element with one of the given keys set
+# to value, with the same result as the check_*_details functions of the audit scripts
+def check_details(osmfile, keys, value, index_path=None):
+    tags = defaultdict(set)
+    with open(osmfile, 'rb') as osm_file:
+        for _, _, offset, length in find_elements(osmfile, keys, value, index_path):
+            elem = read_element(osm_file, offset, length)
+            for t in elem.iter("tag"):
+                tags[t.attrib['k']] = t.attrib['v']
+    return tags
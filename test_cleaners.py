@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import unittest
+import xml.etree.cElementTree as ET
+
+from audit_house_number import update_house_number, update_house_numbers
+from audit_postal_code import mapping, update_post_code, update_post_codes
+from normalizer_cache import BoundedCache
+import prepare_database
+
+# Checks that the column at a time cleaners return what the one value cleaners
+# return, on the values the audits found and on edge inputs.
+#   python -m unittest test_cleaners
+
+HOUSE_NUMBERS = ['12', ' 12 a ', '9A-C', '9a-c', '1 to 4', '1to4', '284--288', '23a;23b', '23a;23b;23c', '2-4',
+                 '2-4-6', 'tto', 'toto', '---', '----', '\t', '', 'a-', '1--a', u'12\xa0', u'9\xe9-c', u'3-\xb2',
+                 u'3-٣', u'23\xdf;4', '60 The General']
+POST_CODES = ['BS1 4DJ', 'BS4 1104', 'BS1 3PH;BS1 3PJ', 'BS5 0SA;BS5 0RX;BS5 0RZ', 'BS8;BS9', 'BS8 1;x', 'BS8 1AA\n',
+              'bs8 1aa', 'BS', '1', 'x;', u'BS\xb2;x', u'BS٣;x', u'BS\xe9;x', u'BS7 9DA']
+# Values the one value cleaners raise IndexError on
+BAD_HOUSE_NUMBERS = ['-a', ' -b', '-', '-2a']
+BAD_POST_CODES = ['', ';x', ';']
+
+
+def update_post_code_mapped(post_code):
+    return update_post_code(post_code, mapping)
+
+
+class BatchCleanerTest(unittest.TestCase):
+
+    def assertSameValues(self, expected, values):
+        self.assertEqual(expected, values)
+        self.assertEqual([type(value) for value in expected], [type(value) for value in values])
+
+    def test_house_numbers(self):
+        numbers, valid = update_house_numbers(HOUSE_NUMBERS)
+        self.assertSameValues(map(update_house_number, HOUSE_NUMBERS), numbers)
+        self.assertEqual(numbers[:3], ['12', '12a', '9A-9C'])
+        self.assertEqual(valid[:3], [True, True, True])
+        self.assertFalse(valid[-1])
+
+    def test_post_codes(self):
+        post_codes, valid = update_post_codes(POST_CODES, mapping)
+        self.assertSameValues(map(update_post_code_mapped, POST_CODES), post_codes)
+        self.assertEqual(post_codes[:5], ['BS1 4DJ', 'BS4', 'BS1 3PJ', 'BS5 0RX', 'BS8;BS9'])
+        self.assertEqual(valid[:5], [True, False, True, True, False])
+
+    def test_failing_values(self):
+        for number in BAD_HOUSE_NUMBERS:
+            self.assertRaises(IndexError, update_house_number, number)
+            self.assertRaises(IndexError, update_house_numbers, ['12', number])
+        for post_code in BAD_POST_CODES:
+            self.assertRaises(IndexError, update_post_code_mapped, post_code)
+            self.assertRaises(IndexError, update_post_codes, ['BS1 4DJ', post_code], mapping)
+
+    def test_separator_in_value(self):
+        numbers = ['1\x002', '3 to 4']
+        self.assertSameValues(map(update_house_number, numbers), update_house_numbers(numbers)[0])
+        post_codes = ['BS1\x00;x', 'BS1;x']
+        self.assertSameValues(map(update_post_code_mapped, post_codes), update_post_codes(post_codes, mapping)[0])
+
+    def test_empty_column(self):
+        self.assertEqual(update_house_numbers([]), ([], []))
+        self.assertEqual(update_post_codes([], mapping), ([], []))
+
+
+class CacheMapTest(unittest.TestCase):
+
+    def test_same_counts_as_calls(self):
+        values = ['1', '2', '1', '3', '2', '1']
+        one_by_one = BoundedCache(update_house_number)
+        batched = BoundedCache(update_house_number)
+        batches = []
+        self.assertEqual(map(one_by_one, values),
+                         batched.map(values, lambda missing: batches.append(missing) or
+                                     update_house_numbers(missing)[0]))
+        self.assertEqual(batches, [['1', '2', '3']])
+        self.assertEqual((batched.hits, batched.misses), (one_by_one.hits, one_by_one.misses))
+        # Cached values are not cleaned again
+        batched.map(['3', '4'], lambda missing: batches.append(missing) or update_house_numbers(missing)[0])
+        self.assertEqual(batches[1], ['4'])
+        self.assertEqual((batched.hits, batched.misses), (4, 4))
+
+
+class CleanModeTest(unittest.TestCase):
+
+    def test_batch_mode_shapes_the_same(self):
+        tags = ''.join('<tag k="{0}" v="{1}"/>'.format(k, v) for k, values in
+                       (('addr:housenumber', HOUSE_NUMBERS[:12]), ('addr:postcode', POST_CODES[:8]))
+                       for v in values)
+        elements = [ET.fromstring('<node id="{0}" lat="1" lon="2" user="u" uid="1" version="1" changeset="1" '
+                                  'timestamp="t">{1}</node>'.format(i, tags)) for i in range(3)]
+        self.assertEqual(list(prepare_database.shape_elements(elements)),
+                         list(prepare_database.shape_elements(elements, 'batch')))
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, list, prepare_database.shape_elements([], 'column'))
+
+
+if __name__ == '__main__':
+    unittest.main()
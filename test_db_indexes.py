@@ -0,0 +1,36 @@
+import unittest
+
+from db_indexes import INDEXES, REFERENCE_QUERIES, check_query_plans, query_plan, reference_database
+
+# Query plan checks of db_indexes, run against an empty database with the pinned
+# REFERENCE_STATS statistics so the plans do not depend on the data at hand.
+#   python -m unittest test_db_indexes
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    def test_reference_queries_use_indexes(self):
+        conn = reference_database()
+        self.assertEqual(check_query_plans(conn), [])
+        conn.close()
+
+    def test_expected_indexes_in_plans(self):
+        conn = reference_database()
+        for name, sql, params, expected in REFERENCE_QUERIES:
+            plan = ' '.join(query_plan(conn, sql, params))
+            for index in expected:
+                self.assertIn(index, plan, '{0}: {1}'.format(name, plan))
+        conn.close()
+
+    def test_missing_index_is_reported(self):
+        indexes = [index for index in INDEXES if 'relation_members_member' not in index]
+        conn = reference_database(indexes)
+        problems = check_query_plans(conn)
+        conn.close()
+        self.assertTrue(any(problem.startswith('relations_using_way: full scan') for problem in problems), problems)
+        self.assertTrue(any(problem.startswith('relations_using_way: index relation_members_member not used')
+                            for problem in problems), problems)
+
+
+if __name__ == '__main__':
+    unittest.main()
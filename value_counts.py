@@ -0,0 +1,173 @@
+import array
+import math
+from collections import Counter
+
+# Bounded-memory value frequencies for the audits. The audit scripts only collect
+# the set of bad values, so a typo seen once looks the same as a problem seen 50,000
+# times. ValueCounts keeps a frequency table per tag key:
+#   - exact counts (a Counter) while the key has at most EXACT_LIMIT distinct values
+#   - past that, a count-min sketch for the counts and the HEAVY_HITTERS most
+#     frequent values as candidates for the top-N report. Counts from the sketch can
+#     only be too high, by at most e * total / SKETCH_WIDTH, most of the time: values
+#     whose count is below that bound cannot be told from noise.
+
+EXACT_LIMIT = 10000
+HEAVY_HITTERS = 100
+SKETCH_WIDTH = 16384
+SKETCH_DEPTH = 4
+TOP_N = 10
+
+MASK64 = (1 << 64) - 1
+
+
+class CountMinSketch(object):
+    """Approximate counts in depth rows of width counters, with conservative update"""
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [array.array('l', [0]) * width for _ in range(depth)]
+
+    def _cells(self, item):
+        # hash() keeps the low bits of ints (and of similar strings) apart poorly, mix
+        # all 64 bits first (the MurmurHash3 finalizer), then double hashing: row i
+        # uses h1 + i * h2
+        h = hash(item) & MASK64
+        h = ((h ^ (h >> 33)) * 0xff51afd7ed558ccd) & MASK64
+        h = ((h ^ (h >> 33)) * 0xc4ceb9fe1a85ec53) & MASK64
+        h ^= h >> 33
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        width = self.width
+        return [(h1 + i * h2) % width for i in range(self.depth)]
+
+    def add(self, item, n=1):
+        """Count item n more times, returns its new estimated count"""
+        cells = list(zip(self.rows, self._cells(item)))
+        estimate = min([row[cell] for row, cell in cells]) + n
+        # Only raise the counters below the new estimate, which keeps the others from overcounting
+        for row, cell in cells:
+            if row[cell] < estimate:
+                row[cell] = estimate
+        return estimate
+
+    def estimate(self, item):
+        return min(row[cell] for row, cell in zip(self.rows, self._cells(item)))
+
+
+class ValueCounter(object):
+    """Counts of the values of one tag key, exact until it has more than exact_limit of them"""
+
+    def __init__(self, exact_limit=EXACT_LIMIT, heavy_hitters=HEAVY_HITTERS, width=SKETCH_WIDTH,
+                 depth=SKETCH_DEPTH):
+        self.exact_limit = exact_limit
+        self.heavy_hitters = heavy_hitters
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.counts = Counter()
+        self.sketch = None
+        # Sketch mode: value -> estimated count of the most frequent values seen, and the
+        # lowest count kept at the last pruning, under which new values are not tracked
+        self.candidates = None
+        self.floor = 0
+
+    @property
+    def exact(self):
+        return self.sketch is None
+
+    def add(self, value, n=1):
+        self.total += n
+        counts = self.counts
+        if counts is not None:
+            if value in counts:
+                counts[value] += n
+            else:
+                counts[value] = n
+                if len(counts) > self.exact_limit:
+                    self._switch_to_sketch()
+            return
+        count = self.sketch.add(value, n)
+        if count > self.floor or value in self.candidates:
+            self.candidates[value] = count
+            if len(self.candidates) > 2 * self.heavy_hitters:
+                self._prune()
+
+    def _switch_to_sketch(self):
+        self.sketch = CountMinSketch(self.width, self.depth)
+        for value, count in self.counts.iteritems():
+            self.sketch.add(value, count)
+        self.candidates = dict(self.counts.most_common(self.heavy_hitters))
+        self.floor = min(self.candidates.values())
+        self.counts = None
+
+    def _prune(self):
+        kept = sorted(self.candidates.iteritems(), key=lambda item: -item[1])[:self.heavy_hitters]
+        self.candidates = dict(kept)
+        self.floor = kept[-1][1]
+
+    def count(self, value):
+        """Return the count of value, an upper bound once the counter uses the sketch"""
+        if self.sketch is None:
+            return self.counts[value]
+        return self.sketch.estimate(value)
+
+    def error(self):
+        """Return how much too high the counts may be (most of the time), 0 while they are exact"""
+        if self.sketch is None:
+            return 0
+        return int(math.ceil(math.e * self.total / self.width))
+
+    def distinct(self):
+        """Return the number of distinct values, None once it is over exact_limit"""
+        return len(self.counts) if self.sketch is None else None
+
+    def most_common(self, n=TOP_N):
+        if self.sketch is None:
+            return self.counts.most_common(n)
+        return sorted(self.candidates.iteritems(), key=lambda item: -item[1])[:n]
+
+
+class ValueCounts(object):
+    """One ValueCounter per tag key"""
+
+    def __init__(self, exact_limit=EXACT_LIMIT, heavy_hitters=HEAVY_HITTERS, width=SKETCH_WIDTH,
+                 depth=SKETCH_DEPTH):
+        self.options = (exact_limit, heavy_hitters, width, depth)
+        self.keys = {}
+
+    def add(self, key, value, n=1):
+        try:
+            counter = self.keys[key]
+        except KeyError:
+            counter = self.keys[key] = ValueCounter(*self.options)
+        counter.add(value, n)
+
+    def count(self, key, value):
+        counter = self.keys.get(key)
+        return 0 if counter is None else counter.count(value)
+
+    def report(self, top_n=TOP_N, keys=None):
+        """
+            returns one entry per tag key, most used keys first, with the total number
+            of values, the number of distinct ones (None past the exact limit), whether
+            the counts are exact, how much too high they may be and the top_n values
+            with their counts
+        """
+        rows = []
+        for key, counter in self.keys.iteritems():
+            if keys is None or key in keys:
+                rows.append({'key': key, 'total': counter.total, 'distinct': counter.distinct(),
+                             'exact': counter.exact, 'error': counter.error(), 'top': counter.most_common(top_n)})
+        rows.sort(key=lambda row: (-row['total'], row['key']))
+        return rows
+
+
+# Function to print a ValueCounts report, one block per tag key
+def print_report(rows):
+    for row in rows:
+        distinct = row['distinct'] if row['distinct'] is not None else '> {0}'.format(EXACT_LIMIT)
+        accuracy = '' if row['exact'] else ', counts may be up to {0} too high'.format(row['error'])
+        print(u'{0}: {1} values, {2} distinct{3}'.format(row['key'], row['total'], distinct, accuracy).encode('utf-8'))
+        for value, count in row['top']:
+            print(u'    {0:>8}  {1}'.format(count, value).encode('utf-8'))
@@ -0,0 +1,74 @@
+import csv
+import itertools
+
+from node_store import NodeStore
+from prepare_database import WAY_NODES_PATH, RowWriter
+from spatial_index import distance_m
+
+# Script to resolve the geometry of each way from ways_nodes.csv and the node store
+# built by prepare_database.process_map(..., node_store=NODE_STORE_PATH). Ways are
+# streamed one at a time and node coordinates are read from the memory-mapped store,
+# so memory does not depend on the number of nodes. Writes one row per way: node
+# count, nodes missing from the store (outside the extract), length in metres and
+# centroid (the length-weighted mean of the segment midpoints, the mean of the
+# nodes for ways of zero length).
+NODE_STORE_PATH = "nodes_store"
+WAY_GEOMETRY_PATH = "ways_geometry.csv"
+WAY_GEOMETRY_FIELDS = ['id', 'nodes', 'missing_nodes', 'closed', 'length_m', 'centroid_lat', 'centroid_lon']
+
+
+# Function yielding (way id, [node ids in position order]) from ways_nodes.csv,
+# which is written grouped by way and in position order
+def read_way_nodes(way_nodes_path=WAY_NODES_PATH):
+    with open(way_nodes_path, 'rb') as f:
+        rows = csv.reader(f)
+        next(rows)
+        for way_id, group in itertools.groupby(rows, lambda row: row[0]):
+            yield int(way_id), [int(row[1]) for row in group]
+
+
+# Function returning (length in metres, centroid lat, centroid lon) of a list of
+# (lat, lon) points, centroid None when there are no points
+def line_geometry(points):
+    length = 0.0
+    lat_sum = lon_sum = 0.0
+    for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+        segment = distance_m(lat1, lon1, lat2, lon2)
+        length += segment
+        lat_sum += segment * (lat1 + lat2) / 2
+        lon_sum += segment * (lon1 + lon2) / 2
+    if length > 0:
+        return length, lat_sum / length, lon_sum / length
+    if points:
+        return 0.0, sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points)
+    return 0.0, None, None
+
+
+# Function yielding the geometry row of each way, in WAY_GEOMETRY_FIELDS order
+def way_geometries(store, way_nodes):
+    get = store.get
+    for way_id, node_ids in way_nodes:
+        points = [p for p in map(get, node_ids) if p is not None]
+        length, lat, lon = line_geometry(points)
+        closed = len(node_ids) > 2 and node_ids[0] == node_ids[-1]
+        yield (way_id, len(node_ids), len(node_ids) - len(points), int(closed), '%.2f' % length,
+               '' if lat is None else '%.7f' % lat, '' if lon is None else '%.7f' % lon)
+
+
+# Function to write the geometry of every way to a csv file
+def write_way_geometries(store_path=NODE_STORE_PATH, way_nodes_path=WAY_NODES_PATH,
+                         out_path=WAY_GEOMETRY_PATH):
+    store = NodeStore(store_path)
+    try:
+        with open(out_path, 'wb') as f:
+            writer = RowWriter(f, WAY_GEOMETRY_FIELDS)
+            writer.writeheader()
+            for row in way_geometries(store, read_way_nodes(way_nodes_path)):
+                writer.writerow(row)
+            writer.close()
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    write_way_geometries()